@@ -0,0 +1,130 @@
+"""Audio sources feeding a CaptureEngine: the microphone or a replayed file.
+
+A source's open(engine) returns a stream with start(), stop() and active,
+like sd.InputStream, that delivers fixed size chunks into engine.q.
+"""
+import threading
+import time
+
+import numpy as np
+import sounddevice as sd
+
+
+class MicrophoneSource(object):
+    """Live capture from an input device, the default one unless given."""
+
+    def __init__(self, device=None):
+        self.device = device
+
+    def open(self, engine):
+        sd.default.channels = engine.channels, engine.channels
+        sd.default.dtype = engine.dtype.name, engine.dtype.name
+        sd.default.samplerate = engine.rate, engine.rate
+
+        return sd.InputStream(samplerate=engine.rate,
+                              device=self.device,
+                              blocksize=engine.chunk_sz,
+                              channels=engine.channels,
+                              callback=engine._audio_callback)
+
+
+class ReplaySource(object):
+    """Replays float audio in [-1, 1] as if it came from the microphone.
+
+    `speed` is the playback rate relative to real time, 0 replays as fast as
+    the engine consumes the chunks without dropping any.  Samples are scaled
+    so they come back out of the engine's high-pass filter at their original
+    level.
+    """
+
+    def __init__(self, audio, rate=16000, speed=1., loop=False):
+        self.audio = np.asarray(audio, dtype=np.float32)
+        self.rate = rate
+        self.speed = speed
+        self.loop = loop
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Loads a WAV (or anything soundfile reads) or a .npy file."""
+        if path.endswith('.npy'):
+            return cls(np.load(path), **kwargs)
+        import soundfile as sf
+        audio, rate = sf.read(path, dtype='float32', always_2d=True)
+        return cls(audio.mean(axis=1), rate=rate, **kwargs)
+
+    def open(self, engine):
+        audio = self.audio
+        if self.rate != engine.rate:
+            from scipy.signal import resample_poly
+            audio = resample_poly(audio, engine.rate, self.rate)
+        full_scale = 1. / engine.hp_filter.scale
+        if np.issubdtype(engine.dtype, np.integer):
+            info = np.iinfo(engine.dtype)
+            audio = np.clip(audio * full_scale, info.min, info.max)
+        # Zero pad to whole chunks.
+        n_chunks = -(-len(audio) // engine.chunk_sz)
+        chunks = np.zeros((n_chunks, engine.chunk_sz), dtype=engine.dtype)
+        chunks.reshape(-1)[:len(audio)] = audio
+        return ReplayStream(chunks, engine.q, engine.rate, self.speed,
+                            self.loop)
+
+
+class ReplayStream(object):
+    """Feeds chunks into a ChunkQueue from a thread, paced like a stream.
+
+    Stopping pauses playback and starting again resumes where it stopped.
+    `position` is the number of chunks delivered so far, and `start_time`
+    the wall clock time chunk 0 would have been captured at.
+    """
+
+    def __init__(self, chunks, q, rate, speed=1., loop=False):
+        self.chunks = chunks
+        self.q = q
+        self.chunk_duration = chunks.shape[1] / rate
+        self.speed = speed
+        self.loop = loop
+        self.position = 0
+        self.start_time = None
+        self.finished = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @property
+    def active(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def capture_time(self, n_chunks):
+        """Wall clock time the first `n_chunks` chunks were fully delivered."""
+        return self.start_time + n_chunks * self.chunk_duration / self.speed
+
+    def start(self):
+        if self.active:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.active:
+            self.thread.join()
+
+    def _run(self):
+        if self.speed > 0:
+            self.start_time = time.time() - \
+                self.position * self.chunk_duration / self.speed
+        while not self.stop_event.is_set():
+            if self.position == len(self.chunks):
+                if not self.loop:
+                    self.finished.set()
+                    return
+                self.position = 0
+                self.start_time = time.time()
+            if self.speed > 0:
+                delay = self.capture_time(self.position + 1) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            elif not self.q.wait_for_space(timeout=0.1):
+                continue
+            self.q.put(self.chunks[self.position])
+            self.position += 1
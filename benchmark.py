@@ -0,0 +1,659 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the audio and text processing paths.
+
+Example call:  `taskset -c 4-7 python3 benchmark.py whisper_input`.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+
+def bench_whisper_input(args):
+    """Allocations per caption iteration when building the whisper input."""
+    from ring_buffer import RingBuffer
+    from transcriber import InputBuffer
+
+    rate = 16000
+    chunk_sz = rate // 10
+    ring = RingBuffer(300, (chunk_sz,), dtype=np.float32)
+    ring.extend(np.random.randn(300, chunk_sz).astype(np.float32))
+    input_buffer = InputBuffer()
+
+    def padded_copy():
+        last_ten_seconds = ring.flat_view(200, 300)
+        return np.pad(last_ten_seconds, (0, 20 * rate), 'constant')
+
+    def preallocated():
+        return input_buffer.write(ring.flat_view(200, 300))
+
+    for name, fn in [('np.pad', padded_copy), ('InputBuffer', preallocated)]:
+        fn()
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        for _ in range(args.iterations):
+            ring.append(np.zeros((chunk_sz,), dtype=np.float32))
+            fn()
+        elapsed = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:>12}: {1e6 * elapsed / args.iterations:8.1f}us/iter, '
+              f'peak traced {peak / 1024:8.1f}KiB')
+
+
+def bench_hp_filter(args):
+    """Speed of ChunkHPFilter and its deviation from the float64 (b, a) form."""
+    from scipy.signal import butter, lfilter
+
+    from input_chunk_filter import ChunkHPFilter
+
+    rate = 16000
+    chunk_sz = rate // 10
+    scale = 2**-27
+    t = np.arange(args.seconds * rate) / rate
+    rng = np.random.default_rng(0)
+    signal = 0.5 * np.sin(2 * np.pi * 10 * t) + 0.3 * np.sin(
+        2 * np.pi * 440 * t) + 0.2 * rng.standard_normal(len(t))
+    chunks = (signal / scale).astype(np.int32).reshape(-1, chunk_sz)
+
+    # The filter used before second-order sections, kept as the reference.
+    b, a = butter(N=6, Wn=args.fc, btype='highpass', fs=rate)
+    zi = np.zeros(max(len(a), len(b)) - 1)
+    t0 = time.perf_counter()
+    reference = []
+    for chunk in chunks:
+        x = chunk.astype(np.float32)
+        y, zi = lfilter(b, a, x, zi=zi)
+        reference.append((y * scale).astype(np.float32))
+    reference_time = time.perf_counter() - t0
+    reference = np.stack(reference)
+
+    hp_filter = ChunkHPFilter(fc=args.fc, scale=scale)
+    t0 = time.perf_counter()
+    per_chunk = np.stack([hp_filter.run(chunk) for chunk in chunks])
+    per_chunk_time = time.perf_counter() - t0
+
+    hp_filter.reset()
+    t0 = time.perf_counter()
+    batched = np.concatenate([
+        hp_filter.run_batch(chunks[i:i + args.batch])
+        for i in range(0, len(chunks), args.batch)
+    ])
+    batched_time = time.perf_counter() - t0
+
+    rms = np.sqrt(np.mean(reference**2))
+    for name, out, elapsed in [('lfilter (b, a)', reference, reference_time),
+                               ('sos per chunk', per_chunk, per_chunk_time),
+                               ('sos batched', batched, batched_time)]:
+        error = np.max(np.abs(out - reference)) / rms
+        print(f'{name:>15}: {1e6 * elapsed / len(chunks):6.1f}us/chunk, '
+              f'max error {error:.1e} of rms')
+        assert error < 1e-3, f'{name} deviates from the reference'
+
+
+def bench_replay(args):
+    """Caption loop real-time factor and latency on a replayed recording."""
+    from audio_source import ReplaySource
+    from recorder import Recorder
+    from transcriber import Transcriber
+
+    whisper = Transcriber(model=args.model)
+    source = ReplaySource.from_file(args.file, speed=args.speed)
+    audio_seconds = len(source.audio) / source.rate
+    t_start = time.time()
+    recorder = Recorder(tts_signal=False,
+                        background=True,
+                        input_buffer=whisper.input_buffer,
+                        source=source)
+    stream = recorder.in_stream
+
+    decode_times = []
+    latencies = []
+    while not stream.finished.is_set():
+        n_chunks = stream.position
+        wav, vad_chunks = recorder.get_audio()
+        if vad_chunks == 0:
+            time.sleep(0.1)
+            continue
+        t0 = time.time()
+        whisper.run(wav)
+        t1 = time.time()
+        decode_times.append(t1 - t0)
+        if args.speed > 0:
+            # From the end of the newest audio in the window to its text.
+            latencies.append(t1 - stream.capture_time(n_chunks))
+    wall_seconds = time.time() - t_start
+
+    window_seconds = recorder.max_duration
+    print(f'{audio_seconds:.1f}s of audio in {wall_seconds:.1f}s, '
+          f'{len(decode_times)} decodes, '
+          f'capture stats {recorder.capture_stats()}')
+    if len(decode_times) > 0:
+        decode_times = np.array(decode_times)
+        print(f'decode: mean {decode_times.mean():.3f}s, '
+              f'real-time factor {decode_times.mean() / window_seconds:.3f} '
+              f'per {window_seconds}s window')
+    if len(latencies) > 0:
+        print(f'latency: mean {np.mean(latencies):.3f}s, '
+              f'p95 {np.percentile(latencies, 95):.3f}s')
+
+
+def bench_pipeline(args):
+    """Caption loop with whisper inline against in a worker process."""
+    from audio_source import ReplaySource
+    from recorder import Recorder
+    from transcriber import Transcriber
+
+    for name, worker in [('inline', False), ('pipelined', True)]:
+        whisper = Transcriber(model=args.model, worker=worker)
+        source = ReplaySource.from_file(args.file, speed=args.speed)
+        recorder = Recorder(tts_signal=False,
+                            background=True,
+                            input_buffer=whisper.input_buffer,
+                            source=source)
+        stream = recorder.in_stream
+
+        # Capture time of the newest audio in each pending window.
+        submitted = []
+        latencies = []
+        n_results = 0
+        max_stall = 0.
+        t_start = time.time()
+        t_iter = t_start
+        while not stream.finished.is_set() or whisper.n_pending > 0:
+            # Same order as the caption loop in main.py.
+            s = whisper.poll(timeout=0.1)
+            if s is not None:
+                n_results += 1
+                latencies.append(time.time() - submitted.pop(0))
+            if whisper.n_pending == 0 and not stream.finished.is_set():
+                n_chunks = stream.position
+                wav, vad_chunks = recorder.get_audio()
+                if vad_chunks != 0:
+                    submitted.append(stream.capture_time(n_chunks))
+                    whisper.submit(wav)
+                elif s is None:
+                    time.sleep(0.1)
+            now = time.time()
+            # How long the display and buttons went without attention.
+            max_stall = max(max_stall, now - t_iter)
+            t_iter = now
+        wall_seconds = time.time() - t_start
+        recorder.engine.worker.stop()
+        whisper.close()
+
+        print(f'{name:>9}: {n_results / wall_seconds:5.2f} decodes/s, '
+              f'latency mean {np.mean(latencies):.3f}s '
+              f'p95 {np.percentile(latencies, 95):.3f}s, '
+              f'longest main loop stall {max_stall:.3f}s')
+
+
+def bench_streams(args):
+    """Streams one process can caption within a refresh interval target."""
+    from audio_source import ReplaySource
+    from caption_server import CaptionServer
+
+    sustained = 0
+    for n_streams in args.streams:
+        server = CaptionServer(
+            {
+                f'stream{i}': ReplaySource.from_file(args.file, loop=True)
+                for i in range(n_streams)
+            },
+            model=args.model,
+            worker=args.worker)
+        t_end = time.monotonic() + args.seconds
+        while time.monotonic() < t_end:
+            if server.step() is None:
+                time.sleep(0.01)
+        server.close()
+
+        intervals = np.concatenate(
+            [stream.refresh_intervals for stream in server.streams])
+        n_decodes = sum(stream.n_decodes for stream in server.streams)
+        p95 = np.percentile(intervals, 95) if len(intervals) > 0 else np.inf
+        per_stream = [stream.n_decodes for stream in server.streams]
+        print(f'{n_streams:3d} streams: {n_decodes / args.seconds:5.2f} '
+              f'decodes/s, refresh interval mean {np.mean(intervals):.2f}s '
+              f'p95 {p95:.2f}s, decodes per stream {min(per_stream)} to '
+              f'{max(per_stream)}')
+        if p95 <= args.target:
+            sustained = max(sustained, n_streams)
+    print(f'{sustained} streams within a {args.target:.1f}s p95 refresh, '
+          f'{sustained / os.cpu_count():.2f} streams per core')
+
+
+def _filter_hallucinations_reference(text, characters=False):
+    """PredictionFilters' filter before the single pass scan."""
+
+    def filter_first(words):
+        REPEAT_THRESHOLD = 3
+        PHRASE_LEN = 8
+        for idx in range(len(words) - REPEAT_THRESHOLD):
+            for phrase_len in range(1, PHRASE_LEN):
+                if idx + phrase_len * REPEAT_THRESHOLD <= len(words):
+                    first_phrase = words[idx:idx + phrase_len]
+                    repeats_found = 1
+                    words_left = len(words) - idx
+                    for repeat_num in range(1, int(words_left / phrase_len)):
+                        start_idx = idx + repeat_num * phrase_len
+                        test_phrase = words[start_idx:start_idx + phrase_len]
+                        if first_phrase == test_phrase:
+                            repeats_found += 1
+                        else:
+                            break
+
+                    if repeats_found > REPEAT_THRESHOLD:
+                        left = words[:idx + REPEAT_THRESHOLD * phrase_len]
+                        right = words[idx + repeats_found * phrase_len:]
+                        return left + right, True
+        return words, False
+
+    words = text if characters else text.split()
+    keep_filtering = True
+    while keep_filtering:
+        words, keep_filtering = filter_first(words)
+    return words if characters else ' '.join(words)
+
+
+def bench_hallucination_filter(args):
+    """Hallucination filter against the repeated first-hit search."""
+    from prediction_filters import PredictionFilters
+
+    pred_filter = PredictionFilters()
+    n = args.words
+    cases = [
+        ('one long loop', ' '.join(['thank you for watching'] * (n // 4)),
+         False),
+        ('many short loops',
+         ' '.join(['so I said', 'no'] * 2 + ['yes'] * 6 + ['and then'] *
+                  5) * (n // 40), False),
+        ('near misses', ' '.join(['a b a b a b a c'] * (n // 8)), False),
+        ('characters', '哈' * n, True),
+        ('character loops', '我们走吧。' * (n // 5), True),
+    ]
+    for name, text, characters in cases:
+        t0 = time.perf_counter()
+        reference = _filter_hallucinations_reference(text, characters)
+        reference_time = time.perf_counter() - t0
+        # The filter itself, filter_hallucinations() returns '' early for
+        # some of these.
+        t0 = time.perf_counter()
+        out = pred_filter._filter_hallucination_impl(
+            list(text) if characters else text.split())
+        out = ''.join(out) if characters else ' '.join(out)
+        elapsed = time.perf_counter() - t0
+        print(f'{name:>16}: reference {1e3 * reference_time:9.2f}ms, '
+              f'single pass {1e3 * elapsed:7.2f}ms, '
+              f'identical {out == reference}')
+
+
+def bench_transcript(args):
+    """Caption splicing cost per iteration as the session grows."""
+    from post_processing import Transcript, combine_words
+
+    rng = np.random.default_rng(0)
+    vocab = [f'word{i}' for i in range(500)]
+    stream = list(rng.choice(vocab, args.words))
+    # Ten second windows advancing about three words per iteration.
+    windows = [
+        ' '.join(stream[max(0, end - 25):end])
+        for end in range(3, args.words, 3)
+    ]
+
+    def splice_string(total_string, s):
+        old_total_string = total_string
+        total_string, needs_update, a_words = combine_words(total_string, s)
+        first_difference = len(old_total_string)
+        for i in range(len(old_total_string)):
+            if old_total_string[i] != total_string[i]:
+                first_difference = i
+                break
+        total_string.split()
+        return total_string
+
+    total_string = ''
+    transcript = Transcript()
+    report_every = len(windows) // 4
+    string_time = transcript_time = 0.
+    for i, s in enumerate(windows):
+        t0 = time.perf_counter()
+        total_string = splice_string(total_string, s)
+        t1 = time.perf_counter()
+        transcript.combine(s)
+        t2 = time.perf_counter()
+        string_time += t1 - t0
+        transcript_time += t2 - t1
+        if (i + 1) % report_every == 0:
+            print(f'{len(transcript):6d} words: string '
+                  f'{1e6 * string_time / report_every:8.1f}us/iter, '
+                  f'Transcript {1e6 * transcript_time / report_every:6.1f}'
+                  f'us/iter')
+            string_time = transcript_time = 0.
+    assert transcript.text == total_string
+
+
+def _offset_scores_reference(a, b, n_offsets, use_distance=True):
+    # What the single pass offset scores must equal.
+    from post_processing import similarity
+
+    return [
+        similarity(a[max(0, len(a) - len(b) + offset):], b, use_distance)
+        for offset in range(n_offsets)
+    ]
+
+
+# post_processing's combine functions before the single pass alignment, kept
+# as the reference.
+def _combine_characters_reference(a, b):
+    ''' Line up the two input strings of utf8 characters so that they match as
+    closely as possible then splice them together.
+
+    Returns (spliced string, needs_update, number of new characters)
+    '''
+    from post_processing import similarity
+
+    if a == "":
+        return b, False, len(b)
+    if b == "":
+        return a, False, 0
+
+    COMBINATION_WINDOW_LEN = 15
+    MAX_NEW_WORDS = 10
+    max_similarity = 0
+    max_similarity_offset = 0
+    for offset in range(min(len(b), MAX_NEW_WORDS)):
+        a_idx = max(0, len(a) - len(b) + offset)
+        sim = similarity(a[a_idx:], b, use_distance=False)
+        if sim > max_similarity:
+            max_similarity = sim
+            max_similarity_offset = offset
+
+    if max_similarity == 0:
+        return a + b, False, len(b)
+    # Prevent editing of old text when nothing new is present.
+    if max_similarity_offset == 0 and len(b) < len(a):
+        return a, False, 0
+
+    a_end_idx = len(b) - max_similarity_offset
+    out_string = a[:-a_end_idx] + b
+
+    words_to_check = min(MAX_NEW_WORDS, len(a),
+                         len(out_string) - max_similarity_offset)
+
+    start_out = len(out_string) - words_to_check - max_similarity_offset
+    end_out = len(out_string) - max_similarity_offset
+    start_a = len(a) - words_to_check
+    end_a = len(a)
+
+    out_comp = [out_string[i] for i in range(start_out, end_out)]
+    a_comp = [a[i] for i in range(start_a, end_a)]
+    needs_update = out_comp != a_comp
+
+    return out_string, needs_update, max_similarity_offset
+
+
+def _combine_words_reference(a, b):
+    ''' Line up the two input strings so that they match as closely as possible
+    then splice them together.
+
+    Returns (spliced string, needs_update, number of new words)
+    '''
+    from post_processing import similarity
+
+    if a == "":
+        return b, False, len(b)
+    if b == "":
+        return a, False, 0
+
+    COMBINATION_WINDOW_LEN = 15
+    MAX_NEW_WORDS = 10
+    a_s = [word for word in a.split(' ') if word != '']
+    b_s = [word for word in b.split(' ') if word != ''
+          ][-COMBINATION_WINDOW_LEN:]
+    max_similarity = 0
+    max_similarity_offset = 0
+    for offset in range(min(len(b_s), MAX_NEW_WORDS)):
+        a_idx = max(0, len(a_s) - len(b_s) + offset)
+        sim = similarity(a_s[a_idx:], b_s)
+        if sim > max_similarity:
+            max_similarity = sim
+            max_similarity_offset = offset
+
+    if max_similarity == 0:
+        return a + ' ' + b, False, len(b_s)
+    # Prevent editing of old text when nothing new is present.
+    if max_similarity_offset == 0 and len(b_s) < len(a_s):
+        return a, False, 0
+
+    # Shorten to max overlap length for combination step.
+    b_s = b_s[-MAX_NEW_WORDS:]
+    a_end_idx = len(b_s) - max_similarity_offset
+    out_wordlist = a_s[:-a_end_idx] + b_s
+
+    words_to_check = min(MAX_NEW_WORDS, len(a_s),
+                         len(out_wordlist) - max_similarity_offset)
+
+    needs_update = any([
+        out_wordlist[-i - max_similarity_offset] != a_s[-i]
+        for i in range(words_to_check)
+    ])
+
+    return ' '.join(out_wordlist), needs_update, max_similarity_offset
+
+
+def bench_align(args):
+    """Single pass combine_words / combine_characters alignment against the
+    per-offset similarity() loops."""
+    import json
+
+    import post_processing
+
+    if args.pairs is not None:
+        # JSON lines of [previous text, new hypothesis].
+        with open(args.pairs) as f:
+            pairs = [json.loads(line) for line in f if line.strip()]
+    else:
+        # Overlapping ten second windows of a session with a few words
+        # misheard, as the caption loop sees them.
+        rng = np.random.default_rng(0)
+        vocab = [f'word{i}' for i in range(300)] + ['a', 'I', 'the', 'to']
+        stream = list(rng.choice(vocab, 3000))
+        a = ''
+        pairs = []
+        for end in range(3, len(stream), 3):
+            window = [
+                w if rng.random() > 0.1 else rng.choice(vocab)
+                for w in stream[max(0, end - 25):end]
+            ]
+            b = ' '.join(window)
+            pairs.append((a, b))
+            a = _combine_words_reference(a, b)[0]
+            # Keep the previous text to a caption screen or so.
+            a = ' '.join(a.split()[-40:])
+
+    # The scores of every offset must equal similarity()'s, also for random
+    # words that are one to three edits apart and tails shorter than b.
+    rng = np.random.default_rng(1)
+    letters = list('abcdeé字')
+    words = [''.join(rng.choice(letters, rng.integers(1, 6)))
+             for _ in range(40)]
+    score_pairs = [(a.split(), b.split()[-15:]) for a, b in pairs] + [
+        (list(rng.choice(words, rng.integers(1, 20))),
+         list(rng.choice(words, rng.integers(1, 16)))) for _ in range(2000)
+    ]
+    matcher = post_processing.WordMatcher(max_words=64)
+    for a_s, b_s in score_pairs:
+        n_offsets = min(len(b_s), 10)
+        assert list(matcher.offset_scores(a_s, b_s, n_offsets)) == \
+            _offset_scores_reference(a_s, b_s, n_offsets)
+        a, b = ''.join(a_s), ''.join(b_s)
+        n_offsets = min(len(b), 10)
+        assert list(post_processing.character_offset_scores(
+            a, b, n_offsets)) == _offset_scores_reference(
+                a, b, n_offsets, use_distance=False)
+    print(f'offset scores match similarity() on {len(score_pairs)} pairs')
+
+    for name, fn, reference, run_pairs in [
+        ('words', post_processing.combine_words, _combine_words_reference,
+         pairs),
+        ('characters', post_processing.combine_characters,
+         _combine_characters_reference,
+         [(a.replace(' ', ''), b.replace(' ', '')) for a, b in pairs])
+    ]:
+        t0 = time.perf_counter()
+        expected = [reference(a, b) for a, b in run_pairs]
+        reference_time = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        out = [fn(a, b) for a, b in run_pairs]
+        elapsed = time.perf_counter() - t0
+        assert out == expected
+        print(f'{name:>10}: reference '
+              f'{1e6 * reference_time / len(run_pairs):7.1f}us/pair, '
+              f'single pass {1e6 * elapsed / len(run_pairs):7.1f}us/pair')
+
+
+def bench_mel(args):
+    """Streaming log-mel front end against recomputing every frame, and
+    against the model's own log-mel."""
+    from transcriber import InputBuffer, StreamingMelFrontEnd
+
+    rate = 16000
+    hop = rate // 10
+    window = 10 * rate
+    rng = np.random.default_rng(0)
+    audio = 0.1 * rng.standard_normal(args.seconds * rate).astype(np.float32)
+    input_buffer = InputBuffer()
+    front_end = StreamingMelFrontEnd()
+
+    for name, cached in [('full', False), ('cached', True)]:
+        elapsed = 0.
+        n_calls = 0
+        for end in range(window, len(audio), hop):
+            start = end - window
+            x = input_buffer.write(audio[start:end], start_sample=start)
+            t0 = time.perf_counter()
+            front_end.run(x, input_buffer.n_valid,
+                          start if cached else None)
+            elapsed += time.perf_counter() - t0
+            n_calls += 1
+        print(f'{name:>7}: {1e3 * elapsed / n_calls:6.2f}ms per 10s window '
+              f'advanced by 100ms')
+
+    # The cached front end stands in for the model's own log-mel, check it
+    # against that on a few windows, cache hits included.
+    from useful_transformers.whisper import WhisperModel
+    model = WhisperModel(args.model)
+    front_end = StreamingMelFrontEnd()
+    max_error = 0.
+    for i, end in enumerate(range(window, len(audio), hop)):
+        start = end - window
+        x = input_buffer.write(audio[start:end], start_sample=start)
+        features = front_end.run(x, input_buffer.n_valid, start)
+        if i % 20 == 0:
+            expected = np.asarray(model.mel_spectrogram(input_buffer.batch),
+                                  dtype=np.float32)
+            max_error = max(
+                max_error,
+                np.max(np.abs(features - expected.reshape(features.shape))))
+    print(f'max abs difference from {args.model} mel_spectrogram: '
+          f'{max_error:.2e}')
+    assert max_error < args.tolerance, \
+        f'log-mel differs from the model by {max_error}'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    whisper_input = subparsers.add_parser(
+        'whisper_input', help='Whisper input buffer allocations per call.')
+    whisper_input.add_argument('--iterations', type=int, default=1000)
+    whisper_input.set_defaults(fn=bench_whisper_input)
+
+    hp_filter = subparsers.add_parser(
+        'hp_filter', help='High-pass filter speed and numerical equivalence.')
+    hp_filter.add_argument('--seconds', type=int, default=60)
+    hp_filter.add_argument('--fc', type=float, default=50.)
+    hp_filter.add_argument('--batch', type=int, default=10)
+    hp_filter.set_defaults(fn=bench_hp_filter)
+
+    replay = subparsers.add_parser(
+        'replay', help='Caption loop real-time factor on a replayed file.')
+    replay.add_argument('file', help='WAV or .npy recording to replay.')
+    replay.add_argument('--model', default='tiny')
+    replay.add_argument('--speed',
+                        type=float,
+                        default=1.,
+                        help='Playback speed, 0 for as fast as possible.')
+    replay.set_defaults(fn=bench_replay)
+
+    pipeline = subparsers.add_parser(
+        'pipeline',
+        help='Caption loop throughput and latency, inline and pipelined.')
+    pipeline.add_argument('file', help='WAV or .npy recording to replay.')
+    pipeline.add_argument('--model', default='tiny')
+    pipeline.add_argument('--speed', type=float, default=1.)
+    pipeline.set_defaults(fn=bench_pipeline)
+
+    streams = subparsers.add_parser(
+        'streams', help='Caption streams per core with one shared model.')
+    streams.add_argument('file', help='WAV or .npy recording to loop.')
+    streams.add_argument('--streams',
+                         type=int,
+                         nargs='+',
+                         default=[1, 2, 4, 8])
+    streams.add_argument('--seconds', type=float, default=30.)
+    streams.add_argument('--target',
+                         type=float,
+                         default=2.,
+                         help='p95 caption refresh interval target.')
+    streams.add_argument('--model', default='tiny')
+    streams.add_argument('--worker', action='store_true')
+    streams.set_defaults(fn=bench_streams)
+
+    hallucination_filter = subparsers.add_parser(
+        'hallucination_filter',
+        help='Hallucination filter speed on pathological outputs.')
+    hallucination_filter.add_argument('--words', type=int, default=1000)
+    hallucination_filter.set_defaults(fn=bench_hallucination_filter)
+
+    transcript = subparsers.add_parser(
+        'transcript', help='Caption splicing cost as the session grows.')
+    transcript.add_argument('--words',
+                            type=int,
+                            default=10000,
+                            help='Session length, an hour is about 10000.')
+    transcript.set_defaults(fn=bench_transcript)
+
+    align = subparsers.add_parser(
+        'align', help='Caption overlap alignment against the reference.')
+    align.add_argument('--pairs',
+                       default=None,
+                       help='JSON lines of [previous text, hypothesis], '
+                       'simulated windows by default.')
+    align.set_defaults(fn=bench_align)
+
+    mel = subparsers.add_parser(
+        'mel', help='Streaming log-mel front end speed and equivalence.')
+    mel.add_argument('--seconds', type=int, default=30)
+    mel.add_argument('--model',
+                     default='tiny',
+                     help='Whisper model whose mel_spectrogram to match.')
+    mel.add_argument('--tolerance',
+                     type=float,
+                     default=1e-3,
+                     help='Largest allowed difference of the normalized '
+                     'log-mel.')
+    mel.set_defaults(fn=bench_mel)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Captions several audio streams with one whisper model.
+
+Each stream has its own Recorder and Transcript, and a single
+Transcriber decodes for all of them.  The scheduler decodes the stream whose
+captions are the most out of date among those with recent voice activity,
+so every talking stream is refreshed in turn and silent ones cost nothing.
+
+Example call:  `python3 caption_server.py mic:0 mic:1 recording.wav`.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from audio_source import MicrophoneSource, ReplaySource
+from post_processing import Transcript
+from prediction_filters import PredictionFilters
+from recorder import Recorder
+from transcriber import Transcriber
+
+
+class CaptionStream(object):
+    """One audio stream and its running caption."""
+
+    def __init__(self, name, source):
+        self.name = name
+        self.recorder = Recorder(tts_signal=False,
+                                 background=True,
+                                 source=source)
+        self.transcript = Transcript()
+        self.last_refresh = time.monotonic()
+        self.refresh_intervals = []
+        self.n_decodes = 0
+
+    def has_voice(self, seconds=3):
+        scores, n_scores = self.recorder.get_vad_state()
+        return np.any(scores[max(0, n_scores - seconds * 10):n_scores] > 0.5)
+
+    def update(self, s):
+        """Adds a transcription, returns the number of new words."""
+        now = time.monotonic()
+        self.refresh_intervals.append(now - self.last_refresh)
+        self.last_refresh = now
+        self.n_decodes += 1
+        _, a_words = self.transcript.combine(s)
+        return a_words
+
+
+class CaptionServer(object):
+
+    def __init__(self, sources, model='tiny', worker=False):
+        """`sources` maps stream names to audio sources."""
+        self.whisper = Transcriber(model=model, worker=worker)
+        self.pred_filter = PredictionFilters()
+        self.streams = [
+            CaptionStream(name, source) for name, source in sources.items()
+        ]
+
+    def step(self):
+        """Decodes the stalest stream with voice activity.
+
+        Returns the stream, or None if no stream had voice activity.
+        """
+        now = time.monotonic()
+        active = []
+        for stream in self.streams:
+            if stream.has_voice():
+                active.append(stream)
+            else:
+                # Silence does not make a stream's captions out of date, so
+                # a stream that starts talking queues behind those waiting.
+                stream.last_refresh = now
+        if len(active) == 0:
+            return None
+        stream = min(active, key=lambda stream: stream.last_refresh)
+        wav, _ = stream.recorder.get_audio()
+        s = self.whisper.run(wav).strip()
+        stream.update(self.pred_filter.filter_hallucinations(s))
+        return stream
+
+    def close(self):
+        for stream in self.streams:
+            stream.recorder.engine.worker.stop()
+            stream.recorder.in_stream.stop()
+        self.whisper.close()
+
+
+def parse_source(spec):
+    """`mic` or `mic:<device>` for a microphone, else a file to replay."""
+    if spec == 'mic':
+        return MicrophoneSource()
+    if spec.startswith('mic:'):
+        device = spec[len('mic:'):]
+        return MicrophoneSource(int(device) if device.isdigit() else device)
+    return ReplaySource.from_file(spec)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sources',
+                        nargs='+',
+                        help='mic, mic:<device> or a recording to replay.')
+    parser.add_argument('--model', default='tiny')
+    parser.add_argument('--worker',
+                        action='store_true',
+                        help='Decode in a worker process.')
+    args = parser.parse_args()
+
+    server = CaptionServer(
+        {f'{i}:{spec}': parse_source(spec)
+         for i, spec in enumerate(args.sources)}, args.model, args.worker)
+    while True:
+        stream = server.step()
+        if stream is None:
+            time.sleep(0.1)
+        else:
+            print(f'[{stream.name}] ' +
+                  ' '.join(stream.transcript.words[-15:]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
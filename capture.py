@@ -0,0 +1,453 @@
+"""Audio capture engine shared by Recorder and VadTriggeredRecorder.
+
+A CaptureEngine owns the input stream, a bounded chunk queue and the
+high-pass filter.  Each batch of chunks is filtered, scored by a pluggable
+VAD backend and handed to a pluggable segmentation policy:
+
+- VAD backends: SileroVad (neural, behind an energy gate) and EnergyVad
+  (chunk level in dB).
+- Policies: SlidingWindowPolicy keeps the most recent audio for captions and
+  endpoints utterances, TriggeredUtterancePolicy records one utterance that
+  starts on sustained voice activity and ends on silence.
+"""
+import os
+import threading
+import time
+from threading import Event
+
+import numpy as np
+import torch
+
+from audio_source import MicrophoneSource
+from chunk_queue import ChunkQueue
+from ring_buffer import RingBuffer
+
+
+def level_db(chunks):
+    """Returns the rms level of each chunk in dB."""
+    rms = np.sqrt(np.mean(np.square(chunks), axis=-1))
+    return 20. * np.log10(np.maximum(rms, 1e-10))
+
+
+class EnergyGate(object):
+    """RMS level gate with hysteresis, run in front of the neural VAD.
+
+    Levels are in dB of the recorder's float scale, where one unit is 2**27
+    of the int32 capture, i.e. roughly 24dB above dBFS.  The gate opens when a
+    chunk rises above `open_db` and only closes again once a chunk falls below
+    `close_db`, so quiet word endings still reach the neural VAD.
+    """
+
+    def __init__(self, open_db=-30., close_db=-35.):
+        self.open_db = open_db
+        self.close_db = close_db
+        self.is_open = False
+
+    def run(self, chunks):
+        """Returns a mask of the chunks that may contain speech."""
+        level = level_db(chunks)
+        # 1 opens the gate, 0 closes it, -1 keeps the previous state.
+        decision = np.full(len(level), -1, dtype=np.int8)
+        decision[level < self.close_db] = 0
+        decision[level > self.open_db] = 1
+        # Carry every decision forward over the chunks that follow it.
+        last = np.where(decision >= 0, np.arange(len(level)), -1)
+        last = np.maximum.accumulate(last)
+        is_open = np.where(last >= 0, decision[last] == 1, self.is_open)
+        if len(is_open) > 0:
+            self.is_open = bool(is_open[-1])
+        return is_open
+
+    def reset(self):
+        self.is_open = False
+
+
+class SileroVad(object):
+    """Silero ONNX VAD probability per chunk, behind an optional EnergyGate.
+
+    Chunks the energy gate rejects are scored 0 without running Silero.
+    """
+
+    def __init__(self, rate=16000, energy_gate=True):
+        self.rate = rate
+        self.energy_gate = EnergyGate() if energy_gate else None
+        self.n_chunks = 0
+        self.n_skipped = 0
+        torch.set_num_threads(1)
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        self.model, _ = torch.hub.load(
+            repo_or_dir=(f"{dir_path}/downloaded/snakers4_silero-vad_master"),
+            source='local',
+            model='silero_vad',
+            force_reload=False,
+            onnx=True)
+
+    def score(self, chunks):
+        scores = np.zeros(len(chunks), dtype=np.float32)
+        candidates = np.ones(len(chunks), dtype=bool)
+        if self.energy_gate is not None:
+            candidates = self.energy_gate.run(chunks)
+        self.n_chunks += len(chunks)
+        self.n_skipped += len(chunks) - np.count_nonzero(candidates)
+        if not candidates.any():
+            return scores
+
+        # Silero carries a recurrent state from one chunk to the next, so the
+        # chunks must go through the model in order.  The model's batch axis
+        # would treat them as independent streams with separate states.
+        frames = torch.from_numpy(chunks[candidates])
+        out = torch.cat([self.model(frame, self.rate) for frame in frames])
+        scores[candidates] = out.numpy().reshape(-1)
+        return scores
+
+    def skip_ratio(self):
+        """Fraction of chunks that did not need the neural VAD."""
+        return self.n_skipped / max(1, self.n_chunks)
+
+    def reset(self):
+        self.model.reset_states()
+        if self.energy_gate is not None:
+            self.energy_gate.reset()
+
+
+class EnergyVad(object):
+    """Chunk level in dB, compared against thresholds by the policy."""
+
+    def score(self, chunks):
+        return level_db(chunks)
+
+    def reset(self):
+        pass
+
+
+class Endpointer(object):
+    """Streaming start and end of speech detection on per-chunk VAD scores.
+
+    Updated once per chunk as audio arrives, so checking whether an utterance
+    has finished is O(1).  Speech needs `min_voiced` chunks scoring above
+    `threshold` and ends `hangover` chunks after the last of them.  `preamble`
+    chunks before the first voiced chunk are kept as part of the utterance.
+    """
+
+    def __init__(self, threshold=0.9, preamble=3, hangover=10, min_voiced=2):
+        self.threshold = threshold
+        self.preamble = preamble
+        self.hangover = hangover
+        self.min_voiced = min_voiced
+        self.reset()
+
+    def reset(self):
+        self.n_chunks = 0
+        self.n_voiced = 0
+        self.first_voice = None
+        self.last_voice = None
+        self.last_voice_time = None
+        self.end = None
+
+    @property
+    def in_speech(self):
+        return self.n_voiced > 0 and self.end is None
+
+    @property
+    def start(self):
+        return max(0, self.first_voice - self.preamble)
+
+    def update(self, scores):
+        now = time.monotonic()
+        for score in scores:
+            if self.end is None:
+                if score > self.threshold:
+                    if self.first_voice is None:
+                        self.first_voice = self.n_chunks
+                    self.last_voice = self.n_chunks
+                    self.last_voice_time = now
+                    self.n_voiced += 1
+                elif self.n_voiced >= self.min_voiced and \
+                        self.n_chunks - self.last_voice >= self.hangover:
+                    self.end = self.last_voice + self.hangover
+            self.n_chunks += 1
+
+
+class SlidingWindowPolicy(object):
+    """Keeps the most recent filtered audio and VAD scores.
+
+    Captions read windows of the latest audio, prompts read the utterance
+    found by the endpointer.  Audio and scores share one write cursor.
+    """
+
+    def __init__(self, n_chunks, chunk_sz):
+        self.chunk_sz = chunk_sz
+        self.audio_ring = RingBuffer(n_chunks, (chunk_sz,), dtype=np.float32)
+        self.vad_ring = RingBuffer(n_chunks, dtype=np.float32)
+        self.endpointer = Endpointer()
+
+    def push(self, raw, audio, scores):
+        self.audio_ring.extend(audio)
+        self.vad_ring.extend(scores)
+        self.endpointer.update(scores)
+
+    def utterance(self, partial=False):
+        """Returns a view of the endpointed utterance, or None.
+
+        With `partial` set, an utterance still in progress is returned up to
+        the latest chunk.
+        """
+        end = self.endpointer.end
+        if end is None and partial and self.endpointer.in_speech:
+            end = self.endpointer.n_chunks
+        if end is None:
+            return None
+        # The endpointer counts chunks since reset, the ring buffer only holds
+        # the most recent ones.
+        offset = self.endpointer.n_chunks - len(self.vad_ring)
+        start_idx = max(0, self.endpointer.start - offset) * self.chunk_sz
+        end_idx = (end - offset) * self.chunk_sz
+        return self.audio_ring.flat_view()[start_idx:end_idx]
+
+    def reset(self):
+        self.audio_ring.reset()
+        self.vad_ring.reset()
+        self.endpointer.reset()
+
+
+class TriggeredUtterancePolicy(object):
+    """Records one utterance of raw audio, triggered by voice activity.
+
+    Recording starts once `n_vad_trigger` consecutive chunks are above
+    `upper_thres` and includes `n_vad_lookback` chunks of pre-roll before
+    them.  It ends once the level stays below `lower_thres` for
+    `prompt_end_delay` seconds, or when the buffer is full.
+    """
+
+    def __init__(self,
+                 n_chunks,
+                 chunk_sz,
+                 dtype=np.int16,
+                 upper_thres=-35,
+                 lower_thres=-42,
+                 n_vad_trigger=3,
+                 n_vad_lookback=3,
+                 prompt_end_delay=0.8):
+        self.chunk_sz = chunk_sz
+        self.upper_thres = upper_thres  # start when VAD goes above this level
+        self.lower_thres = lower_thres  # end when VAD falls below this
+        self.n_vad_trigger = n_vad_trigger  # consecutive +ve blocks needed
+        self.n_vad_lookback = n_vad_lookback  # if triggered, blocks to include
+        self.prompt_end_delay = prompt_end_delay  # seconds
+        self.recording_sta = Event()
+        self.recording_end = Event()
+        self.sta_time = None
+        self.end_time = None
+        self.no_vad_count = 0
+        self.buff_idx = 0
+        self.buff = np.zeros((n_chunks * chunk_sz,), dtype=dtype)
+        n_prefix = self.n_vad_lookback + self.n_vad_trigger
+        self.potential_prefix = RingBuffer(n_prefix, (chunk_sz,), dtype=dtype)
+        self.potential_prefix_vad = RingBuffer(n_prefix, dtype=np.float32)
+        self.reset_potential_prefix()
+
+    def reset_potential_prefix(self):
+        # Start full of silence so the newest chunk is always the last one.
+        n_prefix = self.potential_prefix.n_frames
+        self.potential_prefix.reset()
+        self.potential_prefix.extend(
+            np.zeros((n_prefix, self.chunk_sz), self.buff.dtype))
+        self.potential_prefix_vad.reset()
+        self.potential_prefix_vad.extend(np.full(n_prefix, -np.inf))
+
+    def _has_continuous_vad(self):
+        n_prefix = self.potential_prefix_vad.n_frames
+        recent = self.potential_prefix_vad.view(n_prefix - self.n_vad_trigger)
+        return bool(np.all(recent > self.upper_thres))
+
+    def push(self, raw, audio, scores):
+        """Returns 'silence' or 'max_duration' if a chunk ends the recording.
+
+        Chunks after the end of the recording are ignored.
+        """
+        for chunk, curr_vad in zip(raw, scores):
+            end_reason = self._push_chunk(chunk, curr_vad)
+            if end_reason is not None:
+                return end_reason
+        return None
+
+    def _push_chunk(self, indata, curr_vad):
+        self.potential_prefix.append(indata)
+        self.potential_prefix_vad.append(curr_vad)
+
+        # When voice activity is detected, reset count-down to "end of phrase"
+        if curr_vad > self.upper_thres:
+            self.no_vad_count = 0
+
+        # Begin recording if new voice activity has been detected continuously
+        if not self.recording_sta.is_set() and self._has_continuous_vad():
+            self.sta_time = time.time()
+            self.recording_sta.set()
+            self.buff.fill(0)
+            # add all the chunks in the potential prefix except for the last one
+            # the last chunk will be handled by the code below i.e. the general
+            # case when recording is occurring
+            prefix = self.potential_prefix.flat_view(
+                0, self.potential_prefix.n_frames - 1)
+            self.buff[:len(prefix)] = prefix
+            self.buff_idx = len(prefix)
+
+            print(f'begin recording')
+
+        # Count down to end of voice recording when no voice detected.
+        if self.recording_sta.is_set() and curr_vad < self.lower_thres:
+            self.no_vad_count += 1
+            if self.no_vad_count > self.prompt_end_delay * 10:
+                self.recording_end.set()
+                self.end_time = time.time()
+                self.reset_potential_prefix()
+                return 'silence'
+
+        if not self.recording_sta.is_set():
+            return None
+
+        assert self.recording_sta.is_set()
+        assert not self.recording_end.is_set()
+        self.buff[self.buff_idx:self.buff_idx + self.chunk_sz] = indata
+        self.buff_idx += self.chunk_sz
+
+        if self.buff_idx == len(self.buff):
+            self.recording_end.set()
+            self.end_time = time.time()
+            return 'max_duration'
+        return None
+
+    def reset(self):
+        self.recording_sta.clear()
+        self.recording_end.clear()
+
+
+class CaptureWorker(threading.Thread):
+    """Filters, VAD scores and buffers an engine's audio as it arrives.
+
+    Without a worker the queue is only drained when the main loop asks for
+    audio, so everything captured during a whisper or LLM call is processed
+    in one burst before the next decode.  The worker waits on the queue with the
+    GIL released, and the Silero onnxruntime session releases it while scoring.
+    """
+
+    def __init__(self, engine):
+        super().__init__(daemon=True)
+        self.engine = engine
+        self.stop_event = threading.Event()
+        self.n_processed = 0
+        self.max_queue_depth = 0
+
+    def run(self):
+        while not self.stop_event.is_set():
+            generation = self.engine.generation
+            chunks, discontinuous = self.engine.q.get_all(timeout=0.1)
+            if len(chunks) == 0:
+                continue
+            self.max_queue_depth = max(self.max_queue_depth, len(chunks))
+            self.engine.process(chunks, discontinuous, generation=generation)
+            self.n_processed += len(chunks)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+class CaptureEngine(object):
+    """Input stream, chunk queue, high-pass filter, VAD and policy in one.
+
+    `lock` guards the filter, VAD and policy state when a background worker
+    processes the audio.  Hold it while reading from the policy.
+    """
+
+    def __init__(self,
+                 policy,
+                 vad,
+                 hp_filter,
+                 rate=16000,
+                 chunk_sz=1600,
+                 dtype=np.int32,
+                 channels=1,
+                 queue_chunks=300):
+        self.policy = policy
+        self.vad = vad
+        self.hp_filter = hp_filter
+        self.rate = rate
+        self.chunk_sz = chunk_sz
+        self.dtype = np.dtype(dtype)
+        self.channels = channels
+        self.q = ChunkQueue(queue_chunks, chunk_sz, self.dtype)
+        self.lock = threading.RLock()
+        # Counts resets, audio read from the queue before one is stale.
+        self.generation = 0
+        self.worker = None
+        self.in_stream = None
+
+    def open_stream(self, source=None):
+        """Opens `source`, the microphone by default, feeding this engine."""
+        source = MicrophoneSource() if source is None else source
+        self.in_stream = source.open(self)
+        return self.in_stream
+
+    def _audio_callback(self, indata, frames, time_info, status):
+        self.q.put(np.frombuffer(indata, dtype=self.dtype), status)
+
+    def start_worker(self):
+        self.worker = CaptureWorker(self)
+        self.worker.start()
+
+    def process(self,
+                chunks=None,
+                discontinuous=False,
+                timeout=0,
+                generation=None):
+        """Processes `chunks`, or every queued chunk, in one batch.
+
+        Returns whatever the policy returns for the batch.  When reading from
+        the queue, waits up to `timeout` seconds for the first chunk.  Chunks
+        read from the queue at an older `generation` are dropped, they were
+        captured before a reset.
+        """
+        if chunks is None:
+            generation = self.generation
+            chunks, discontinuous = self.q.get_all(timeout)
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return None
+            if discontinuous:
+                # Audio was dropped, the filter state no longer matches.
+                self.hp_filter.reset()
+            if len(chunks) == 0:
+                return None
+            # The filter is stateful, so running it over the concatenated
+            # backlog matches running it chunk by chunk.
+            audio = self.hp_filter.run_batch(chunks)
+            return self.policy.push(chunks, audio, self.vad.score(audio))
+
+    def sync(self):
+        # With a background worker the policy is already up to date.
+        if self.worker is None:
+            self.process()
+
+    def reset(self):
+        """Processes pending audio, then clears the policy and filter state."""
+        with self.lock:
+            self.sync()
+            # Whatever the worker has taken or left in the queue by now was
+            # captured before the reset.
+            self.generation += 1
+            self.q.get_all()
+            self.policy.reset()
+            self.hp_filter.reset()
+            self.vad.reset()
+
+    def stats(self):
+        stats = {
+            'queue_depth': self.q.qsize(),
+            'dropped_chunks': self.q.n_dropped,
+            'input_overflows': self.q.n_overflows,
+        }
+        if self.worker is not None:
+            stats['max_queue_depth'] = self.worker.max_queue_depth
+            stats['processed_chunks'] = self.worker.n_processed
+        return stats
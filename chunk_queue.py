@@ -0,0 +1,96 @@
+"""Bounded queue of audio chunks for passing audio out of a stream callback."""
+import threading
+
+import numpy as np
+
+
+class ChunkQueue:
+    """Preallocated FIFO of fixed size chunks that drops the oldest when full.
+
+    The stream callback copies each chunk into a free slot, so memory stays
+    flat however long the consumer stalls.  Chunks lost to the drop-oldest
+    policy and input overflows flagged by PortAudio are counted, and the next
+    read reports that the audio is discontinuous so stateful filters can be
+    reset.
+    """
+
+    def __init__(self, n_slots, chunk_sz, dtype):
+        self.n_slots = n_slots
+        self.slots = np.zeros((n_slots, chunk_sz), dtype=dtype)
+        self.read_idx = 0
+        self.size = 0
+        self.n_dropped = 0  # Chunks overwritten before they were read.
+        self.n_overflows = 0  # PortAudio callbacks flagged input_overflow.
+        self.discontinuous = False
+        self.cond = threading.Condition()
+
+    def put(self, chunk, status=None):
+        with self.cond:
+            if status is not None and status.input_overflow:
+                self.n_overflows += 1
+                self.discontinuous = True
+            if self.size == self.n_slots:
+                self.read_idx = (self.read_idx + 1) % self.n_slots
+                self.size -= 1
+                self.n_dropped += 1
+                self.discontinuous = True
+            self.slots[(self.read_idx + self.size) % self.n_slots] = chunk
+            self.size += 1
+            self.cond.notify_all()
+
+    def _wait(self, timeout):
+        if self.size == 0 and timeout != 0:
+            self.cond.wait_for(lambda: self.size > 0, timeout=timeout)
+
+    def _take_discontinuity(self):
+        discontinuous = self.discontinuous
+        self.discontinuous = False
+        return discontinuous
+
+    def get(self, timeout=None):
+        """Returns (oldest chunk or None, whether audio was lost before it).
+
+        Blocks until a chunk is available, or for at most `timeout` seconds.
+        """
+        with self.cond:
+            self._wait(timeout)
+            if self.size == 0:
+                return None, False
+            chunk = self.slots[self.read_idx].copy()
+            self.read_idx = (self.read_idx + 1) % self.n_slots
+            self.size -= 1
+            self.cond.notify_all()
+            return chunk, self._take_discontinuity()
+
+    def get_all(self, timeout=0):
+        """Returns (all queued chunks oldest first, whether audio was lost).
+
+        Only waits for the first chunk if a non-zero `timeout` is given.
+        """
+        with self.cond:
+            self._wait(timeout)
+            idx = (self.read_idx + np.arange(self.size)) % self.n_slots
+            chunks = self.slots[idx]
+            self.read_idx = (self.read_idx + self.size) % self.n_slots
+            self.size = 0
+            self.cond.notify_all()
+            return chunks, self._take_discontinuity()
+
+    def wait_for_space(self, timeout=None):
+        """Waits until put() would not drop a chunk, False on timeout.
+
+        Only for producers that may block, never the stream callback.
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: self.size < self.n_slots,
+                                      timeout=timeout)
+
+    def qsize(self):
+        return self.size
+
+    def clear(self):
+        with self.cond:
+            self.read_idx = 0
+            self.size = 0
+            self.discontinuous = False
+            self.cond.notify_all()
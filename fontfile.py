@@ -1,5 +1,9 @@
 import os
 
+# Written without spaces between words, so captions are combined and
+# rendered per character.
+UNSPACED_LANGUAGES = ('chinese', 'japanese', 'thai')
+
 
 def lang_to_font(lang):
     base_dir = os.path.realpath(os.path.dirname(__file__))
@@ -13,3 +17,7 @@ def lang_to_font(lang):
         return os.path.join(base_dir, 'fonts/noto_thai.ttf')
     else:
         return os.path.join(base_dir, 'fonts/noto_default.ttf')
+
+
+def lang_is_unspaced(lang):
+    return lang in UNSPACED_LANGUAGES
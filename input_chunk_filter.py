@@ -1,25 +1,41 @@
 """Class for high pass filtering of the input stream."""
 import numpy as np
-from scipy.signal import lfilter, butter
+from scipy.signal import butter, sosfilt
 
 
 class ChunkHPFilter:
-    """Filters chunks of data, uses scipy lfilter method."""
+    """Filters chunks of data with second-order sections, in float32.
 
-    def __init__(self, fc=100., order=6, rate=16000.):
+    Input of any numeric dtype, e.g. the int32 capture buffer, is converted
+    to float32 and multiplied by `scale` on the way in.  The filter is linear
+    so this is the same as scaling the output.
+    """
+
+    def __init__(self, fc=100., order=6, rate=16000., scale=1.):
         # Design coefficients for 6th order high-pass filter suitable for speech.
-        self.b, self.a = butter(N=order, Wn=fc, btype='highpass', fs=rate)
+        # Cascaded biquads stay stable in float32 where the (b, a) form of a
+        # low cut-off filter would not.
+        self.sos = butter(N=order,
+                          Wn=fc,
+                          btype='highpass',
+                          fs=rate,
+                          output='sos').astype(np.float32, order='C')
+        self.scale = np.float32(scale)
         self.zi = None
         self.reset()
 
     def run(self, chunk: np.ndarray) -> np.ndarray:
         """Returns filtered chunk of arbitrary length."""
+        x = np.multiply(chunk, self.scale, dtype=np.float32)
         # Apply the filter to the data chunk using the initial conditions.
-        filtered_chunk, self.zi = lfilter(self.b, self.a, chunk, zi=self.zi)
-
+        filtered_chunk, self.zi = sosfilt(self.sos, x, zi=self.zi)
         return filtered_chunk
 
+    def run_batch(self, chunks: np.ndarray) -> np.ndarray:
+        """Filters (n_chunks, chunk_sz) consecutive chunks in one call."""
+        return self.run(chunks.reshape(-1)).reshape(chunks.shape)
+
     def reset(self) -> None:
-        # Resets the lfilter zi value to zero.  Use after a chunk drop to prevent
+        # Resets the sosfilt zi value to zero.  Use after a chunk drop to prevent
         # unexpected filter output.
-        self.zi = np.zeros(max(len(self.a), len(self.b)) - 1)
+        self.zi = np.zeros((self.sos.shape[0], 2), dtype=np.float32)
@@ -3,7 +3,11 @@
 LLM Speaker class that can evaluate a prompt and start speaking as the response
 is generated.
 """
+import collections
+import ctypes
+import hashlib
 import os
+import pickle
 import time
 from threading import Thread
 from typing import List
@@ -30,6 +34,50 @@ model_param_dict = {
 }
 
 
+class ContextWindow(object):
+    """Conversation turns held in the llama context after the system prompt.
+
+    The system prompt's `pinned` tokens always stay.  When a turn would not
+    fit with `n_reserve` tokens to spare for the response, the oldest whole
+    turns are evicted until the history is at most `n_history` tokens, so
+    evictions are rare and never split a turn.  llama.cpp in this version
+    cannot shift its KV cache, so the caller evaluates the kept turns again.
+    """
+
+    def __init__(self, n_ctx, pinned, n_reserve=256, n_history=None):
+        self.n_ctx = n_ctx
+        self.pinned = list(pinned)
+        self.n_pinned = len(pinned)
+        self.n_reserve = n_reserve
+        self.n_history = (n_ctx - self.n_pinned) // 4 if n_history is None \
+            else n_history
+        self.turns = collections.deque()
+        self.n_tokens = self.n_pinned
+
+    def clear(self):
+        self.turns.clear()
+        self.n_tokens = self.n_pinned
+
+    def add_turn(self, tokens):
+        self.turns.append(tokens)
+        self.n_tokens += len(tokens)
+
+    def fits(self, n_new):
+        return self.n_tokens + n_new + self.n_reserve <= self.n_ctx
+
+    def evict(self, n_new=0):
+        """Drops the oldest turns, returns the tokens of those kept."""
+        while len(self.turns) > 0 and (
+                self.n_tokens - self.n_pinned > self.n_history or
+                not self.fits(n_new)):
+            self.n_tokens -= len(self.turns.popleft())
+        return [tok for turn in self.turns for tok in turn]
+
+    def tokens(self):
+        """All tokens in the context, pinned ones first."""
+        return self.pinned + [tok for turn in self.turns for tok in turn]
+
+
 class LLMSpeaker(object):
 
     def __init__(self, model_str="orca3b-4bit"):
@@ -63,6 +111,105 @@ class LLMSpeaker(object):
             use_mlock=True,
             use_mmap=False)
 
+        # The llama state right after the system prompt.  Resets go back to
+        # it instead of an empty context, keeping the persona without
+        # evaluating the prompt again, and it is kept on disk so a cold boot
+        # does not evaluate it either.
+        self.system_prompt = f"{self.init_prompt}\n\n"
+        model_stat = os.stat(self.llm.model_path)
+        key = repr((filename, model_stat.st_size, model_stat.st_mtime_ns,
+                    model_params, llama_cpp.__version__))
+        key = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+        self.state_file = f'{dir_path}/downloaded/{filename}.{key}.state'
+        self.system_state = None
+        self.load_system_prompt()
+        self.context = ContextWindow(self.n_ctx, self.system_tokens)
+        self.llm_th = None
+        self.compact_th = None
+        self.prefill_th = None
+
+    def load_system_prompt(self):
+        """Restores the system prompt state from disk, else evaluates it."""
+        t0 = time.perf_counter()
+        self.system_tokens = self.llm.tokenize(
+            bytes(self.system_prompt, "utf-8"))
+        self.n_system_tokens = len(self.system_tokens)
+        # The model writes logits into (n_ctx, n_vocab) scores, about 260MB,
+        # but the system state only keeps the system prompt's rows, which are
+        # copied back into this buffer on every restore.
+        self.llm_scores = self.llm.scores
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'rb') as f:
+                    _, fields = pickle.load(f)
+                # The state data is a ctypes array, which does not pickle.
+                data = fields['llama_state']
+                fields['llama_state'] = (ctypes.c_uint8 *
+                                         len(data)).from_buffer_copy(data)
+                self.system_state = llama_cpp.LlamaState(**fields)
+                self.load_system_state()
+                printc(
+                    "yellow", "loaded system prompt state in "
+                    f"{time.perf_counter() - t0:.2f}s")
+                return
+            except Exception as e:
+                # E.g. a file written by another llama_cpp build.
+                printc("red", f"rebuilding system prompt state: {e}")
+                try:
+                    os.remove(self.state_file)
+                except OSError:
+                    pass
+
+        self.llm.reset()
+        self.llm.eval(self.system_tokens)
+        state = self.llm.save_state()
+        self.system_state = llama_cpp.LlamaState(
+            **dict(vars(state),
+                   scores=state.scores[:self.n_system_tokens].copy()))
+        del state
+        self.load_system_state()
+        printc(
+            "yellow", f"evaluated system prompt ({self.n_system_tokens} "
+            f"tokens) in {time.perf_counter() - t0:.2f}s")
+
+        fields = dict(vars(self.system_state))
+        fields['llama_state'] = bytes(fields['llama_state'])
+        try:
+            # Written aside and renamed, a partial file is never loaded.
+            with open(self.state_file + '.tmp', 'wb') as f:
+                pickle.dump((self.n_system_tokens, fields), f)
+            os.replace(self.state_file + '.tmp', self.state_file)
+        except OSError as e:
+            printc("red", f"could not save system prompt state: {e}")
+
+    def load_system_state(self):
+        """Loads the system prompt state into the model."""
+        self.llm.load_state(self.system_state)
+        # load_state() swaps in a copy of the state's scores, only as long as
+        # the system prompt, so generation gets the full size buffer back.
+        n_rows = len(self.llm.scores)
+        self.llm_scores[:n_rows] = self.llm.scores
+        self.llm.scores = self.llm_scores
+        self.n_tokens_processed = self.n_system_tokens
+
+    def restore_system_prompt(self):
+        """Returns the context to just after the system prompt."""
+        self.load_system_state()
+        self.context.clear()
+
+    def compact_context(self, n_new=0):
+        """Evicts the oldest turns, evaluating the kept ones again."""
+        t0 = time.perf_counter()
+        n_before = self.context.n_tokens
+        kept = self.context.evict(n_new)
+        self.load_system_state()
+        if len(kept) > 0:
+            self.llm.eval(kept)
+        self.n_tokens_processed = self.context.n_tokens
+        printc(
+            "yellow", f"context {n_before} -> {self.context.n_tokens} tokens "
+            f"in {time.perf_counter() - t0:.2f}s")
+
     def save_logs(self, sentence):
         if len(sentence.split()) < 1 or len(sentence) == 0:
             printf(self.logfile, f"\\", end="", flush=True)
@@ -114,28 +261,69 @@ class LLMSpeaker(object):
         #       toks[-1])
         return logits
 
-    def reset_state_on_nth_token(self, limit):
-        if self.n_tokens_processed > limit:
-            self.llm.reset()
-            self.n_tokens_processed = 0
+    def _join_background(self):
+        # Compaction and prefill use the llm outside of a response.
+        for th in (self.compact_th, self.prefill_th):
+            if th is not None:
+                th.join()
+        self.compact_th = None
+        self.prefill_th = None
+
+    def prefill(self, user_prefix=''):
+        """Evaluates the start of the next prompt while the user speaks.
+
+        `user_prefix` holds the user's words known so far, e.g. the stable
+        part of a partial transcript.  start() then only evaluates its
+        prompt from the first token that differs.  Returns False if the llm
+        is busy.
+        """
+        for th in (self.llm_th, self.compact_th, self.prefill_th):
+            if th is not None and th.is_alive():
+                return False
+        self.prefill_th = Thread(target=self._prefill,
+                                 args=(f"{self.prefix}{user_prefix}",),
+                                 daemon=False)
+        self.prefill_th.start()
+        return True
+
+    def _prefill(self, prompt_str):
+        # The last token may merge with the text that follows it.
+        ptokens = self.llm.tokenize(bytes(prompt_str, "utf-8"))[:-1]
+        if len(ptokens) == 0 or not self.context.fits(len(ptokens)):
+            return
+        t0 = time.perf_counter()
+        # generate() rolls the llama state back to the longest prefix it
+        # shares with the tokens and evaluates the rest, only the first
+        # sample is wasted.
+        next(self.llm.generate(self.context.tokens() + ptokens, reset=True))
+        printc(
+            "yellow", f"prefilled {len(ptokens)} prompt tokens in "
+            f"{time.perf_counter() - t0:.2f}s")
 
-    def llm_producer(self, prompt_str):
+    def llm_producer(self, prompt_str, restart=False):
         self.response_done = False
+        self._join_background()
+        if restart:
+            self.restore_system_prompt()
         ptokens = self.llm.tokenize(bytes(prompt_str, "utf-8"))
-        self.n_tokens_processed += len(ptokens)
-        self.total_tokens_processed += len(ptokens)
 
-        # 256 tokens should be a reasonable buffer to allow all but the longest
-        # responses without resetting the LLM.
-        self.reset_state_on_nth_token(self.n_ctx - 256)
+        # Normally compacted after the last response, this only catches
+        # prompts too long for the room left.
+        if not self.context.fits(len(ptokens)):
+            self.compact_context(len(ptokens))
+        self.n_tokens_processed = self.context.n_tokens + len(ptokens)
+        self.total_tokens_processed += len(ptokens)
+        turn = list(ptokens)
 
+        # Whole context, so generate() keeps the evaluated prefix, including
+        # any prefilled part of this prompt, and evaluates the rest.
         resp_gen = self.llm.generate(
-            ptokens,
+            self.context.tokens() + ptokens,
             top_k=40,
             top_p=0.95,
             temp=0.25,
             repeat_penalty=1.1,
-            reset=False,
+            reset=True,
             frequency_penalty=0.0,
             presence_penalty=0.0,
             tfs_z=1.0,
@@ -148,24 +336,23 @@ class LLMSpeaker(object):
         sentence = ""
         first = False
         for tok in resp_gen:
-            self.n_tokens_processed += 1
-            self.total_tokens_processed += 1
-
-            # This is here just in case a very long response is generated when the llm
-            # nears capacity. This should basically never happen because the token
-            # limit is conservative.
-            self.reset_state_on_nth_token(self.n_ctx)
-
             if not first:
                 printf(self.logfile, f"{prompt_str}", end="", flush=True)
                 first = True
 
-            if tok == self.llm.token_eos():
+            # A response that fills the context ends there, which should
+            # basically never happen as n_reserve is conservative.
+            if tok == self.llm.token_eos() or \
+                    self.n_tokens_processed >= self.n_ctx:
                 self.save_logs(sentence)
                 sentence = ""
                 printf(self.logfile, "\n" + "_" * 70 + "\n")
                 break
 
+            self.n_tokens_processed += 1
+            self.total_tokens_processed += 1
+            turn.append(tok)
+
             word = self.llm.detokenize([tok]).decode("utf-8", errors="ignore")
             if self.llm_producer_callback is not None:
                 self.llm_producer_callback(word)
@@ -182,6 +369,13 @@ class LLMSpeaker(object):
                tok in {self.llm.token_eos(), self.llm.token_nl()}:
                 self.save_logs(sentence)
                 sentence = ""
+
+        # Evict old turns while the response is spoken, rather than when the
+        # next prompt arrives.
+        self.context.add_turn(turn)
+        if not self.context.fits(self.context.n_reserve):
+            self.compact_th = Thread(target=self.compact_context, daemon=False)
+            self.compact_th.start()
         self.response_done = True
 
     def get_response(self):
@@ -190,20 +384,20 @@ class LLMSpeaker(object):
         return response
 
     def start_first(self):
+        # The system prompt is already evaluated, only the greeting is new.
         init_prompt = \
-            f"{self.init_prompt}\n\n"\
             f"{self.prefix}Hello!\n"\
             f"{self.suffix}"
-        self._start(init_prompt)
+        self._start(init_prompt, restart=True)
 
     def start(self, user_prompt):
         user_prompt = f"{self.prefix}{user_prompt}\n"\
                       f"{self.suffix}"
         self._start(user_prompt)
 
-    def _start(self, prompt_str):
+    def _start(self, prompt_str, restart=False):
         self.llm_th = Thread(target=self.llm_producer,
-                             args=(prompt_str,),
+                             args=(prompt_str, restart),
                              daemon=False)
         printc(
             "yellow", "starting response pipeline ("
@@ -3,14 +3,16 @@
 Chatty - a talking robot
 """
 
+import argparse
 import sys
 import time
 import fasteners
 
+from audio_source import ReplaySource
 from buttons import ButtonHandler
-from fontfile import lang_to_font
+from fontfile import lang_is_unspaced, lang_to_font
 from llm_speaker import LLMSpeaker
-from post_processing import combine_words
+from post_processing import Transcript
 from prediction_filters import PredictionFilters
 from printing import printc, printf
 from recorder import Recorder
@@ -20,12 +22,11 @@ from render import SingleScreenRenderer
 from render import SplitScreenRenderer
 from state_machine import AIBoxState
 from state_machine import StateMachine
-from transcriber import Transcriber
+from transcriber import AdaptiveTranscriber, StreamingTranscriber
 from translator import Translator
 from volume_file import get_current_volume
 from tts import TTS_LOCKFILE
 import serial
-import copy
 
 
 def tts_playing(tts_lock):
@@ -36,26 +37,58 @@ def tts_playing(tts_lock):
         return True
 
 
-def main(model_str):
+def main(model_str,
+         replay_file=None,
+         streaming_captions=False,
+         inline_whisper=False,
+         whisper_models=('tiny', ),
+         caption_lang='english'):
+    # Languages written without spaces are captioned a character at a time.
+    caption_characters = lang_is_unspaced(caption_lang)
     display = BaseDisplay()
-    renderer = SingleScreenRenderer(display)
+    renderer = SingleScreenRenderer(display, caption_lang)
     splitscreen_renderer = SplitScreenRenderer(display)
     renderer.clear()
     renderer.addWord('booting...')
-    whisper = Transcriber(model='tiny')
+    # Whisper decodes in a worker process so the display, buttons and serial
+    # output stay live during a decode.  Given several model variants, the
+    # largest that keeps up with the latency target is used.  Each variant has
+    # its own worker and model, so only one is loaded unless asked for.
+    whisper = AdaptiveTranscriber(models=whisper_models,
+                                  worker=not inline_whisper)
     llm_speaker = LLMSpeaker(model_str)
     state_machine = StateMachine()
+    caption_lang_code = state_machine.lang_to_whisper(caption_lang)
+    if caption_lang_code is None:
+        raise ValueError(f'Unsupported caption language: {caption_lang}')
     main_menu = MainMenu(display, state_machine.get_source_languages(),
                          state_machine.get_target_languages())
     buttons = ButtonHandler()
     serial_output = serial.Serial('/dev/ttyS6', 115200, timeout=1)
 
-    recorder = Recorder()
+    # A replayed recording stands in for the microphone when given.
+    source = ReplaySource.from_file(replay_file) if replay_file else None
+    recorder = Recorder(background=True,
+                        input_buffer=whisper.input_buffer,
+                        source=source)
     pred_filter = PredictionFilters()
     translator = Translator()
 
+    def filter_captions(s):
+        return pred_filter.filter_hallucinations(
+            s, characters=caption_characters)
+
+    # Commits caption words once consecutive decodes agree instead of
+    # re-decoding and splicing the last ten seconds.
+    streamer = StreamingTranscriber(
+        whisper, text_filter=filter_captions,
+        characters=caption_characters) if streaming_captions else None
+
     first_llm_invocation = False
-    total_string = ''
+    transcript = Transcript(characters=caption_characters)
+    # Caption units redrawn when a decode revises earlier text, enough to fill
+    # the last two lines.
+    n_revised_units = 40 if caption_characters else 20
 
     # Purge audio buffer while transient occurs.
     audio, vad = recorder.get_audio()
@@ -83,43 +116,84 @@ def main(model_str):
             src_lang, tgt_lang = state_machine.get_translate_languages()
             splitscreen_renderer.setLanguages(src_lang, tgt_lang, draw=draw)
 
+    def transcribe(wav, src_lang='en', draw=False, prompt_word=''):
+        # The worker decodes while the menu stays live.
+        whisper.submit(wav, src_lang=src_lang)
+        s = whisper.poll(timeout=0.1)
+        while s is None:
+            handle_menu(draw=draw, prompt_word=prompt_word)
+            s = whisper.poll(timeout=0.1)
+        return s.strip()
+
+    def prefill_partial(prev_words, n_submitted):
+        # Decodes the prompt spoken so far, at most once per second of new
+        # audio, and prefills the LLM with the words two decodes agree on.
+        s = whisper.poll()
+        if s is not None:
+            words = s.strip().split()
+            n_agreed = 0
+            for prev, curr in zip(prev_words, words):
+                if prev != curr:
+                    break
+                n_agreed += 1
+            if n_agreed > 0:
+                llm_speaker.prefill(' '.join(words[:n_agreed]))
+            prev_words = words
+        if whisper.n_pending == 0:
+            # Nothing is submitted once the speaker pauses, so a decode is
+            # rarely still running when the prompt ends.
+            partial = recorder.partial_voice(min_samples=n_submitted +
+                                             recorder.rate)
+            if partial is not None:
+                whisper.submit(partial)
+                n_submitted = len(partial)
+        return prev_words, n_submitted
+
     while True:
         if state_machine.get_state() == AIBoxState.CAPTION:
             handle_menu(draw=False, prompt_word='Ready...')
             if tts_playing(tts_lock):
                 continue
-            wav, vad_chunks = recorder.get_audio()
-            s = ""
-            if vad_chunks != 0:
-                s = whisper.run(wav).strip()
-                s = pred_filter.filter_hallucinations(s)
+            if streamer is not None:
+                new_words, tentative = streamer.step(
+                    recorder, src_lang=caption_lang_code)
+                s = transcript.separator.join(streamer.hypothesis)
+                if len(s) == 0:
+                    time.sleep(0.1)
             else:
-                time.sleep(0.1)
+                # Submit the next window before rendering this result, so
+                # the two overlap.
+                s = whisper.poll(timeout=0.1)
+                if whisper.n_pending == 0:
+                    wav, vad_chunks = recorder.get_audio()
+                    if vad_chunks != 0:
+                        whisper.submit(wav, src_lang=caption_lang_code)
+                    elif s is None:
+                        time.sleep(0.1)
+                s = "" if s is None else filter_captions(s.strip())
 
-            if total_string == "" and len(s) > 0:
+            if len(transcript) == 0 and len(s) > 0:
                 renderer.clear()
-            old_total_string = copy.copy(total_string)
-            total_string, needs_update, a_words = combine_words(total_string, s)
-            first_difference = len(old_total_string)
-            for i in range(len(old_total_string)):
-                if old_total_string[i] != total_string[i]:
-                    first_difference = i
-                    break
-            n_updated = len(old_total_string) - first_difference
-            string_to_write = ''
-            for _ in range(n_updated):
-                string_to_write += '\b'
-            string_to_write += total_string[first_difference:]
-            serial_output.write(bytes(string_to_write, 'utf-8'))
+            if streamer is not None:
+                # Only the words after those committed before this step can
+                # change.
+                needs_update, a_words = transcript.revise(
+                    new_words + tentative,
+                    len(streamer.committed) - len(new_words))
+            else:
+                needs_update, a_words = transcript.combine(s)
+            n_updated, new_text = transcript.last_edit
+            serial_output.write(bytes('\b' * n_updated + new_text, 'utf-8'))
 
             if needs_update:
-                words_to_update = total_string.split()
-                # We will never need to update more than 20 words across the last two lines.
+                words_to_update = transcript.words
+                # We will never need to update more than n_revised_units
+                # words across the last two lines.
                 renderer.updateNLines(
-                    2, words_to_update[-20 - a_words:len(words_to_update) -
-                                       a_words])
+                    2, words_to_update[-n_revised_units -
+                                       a_words:len(words_to_update) - a_words])
             if a_words > 0:
-                renderer.addWords(total_string.split()[-a_words:])
+                renderer.addWords(transcript.words[-a_words:])
 
             state_change = state_machine.update_state(s, buttons.up_pressed(),
                                                       buttons.down_pressed())
@@ -131,9 +205,11 @@ def main(model_str):
                     llm_speaker.start_first()
                     llm_speaker.wait()
                     first_llm_invocation = False
+                whisper.discard()
                 recorder.reset()
             elif state_change == AIBoxState.TRANSLATE:
                 renderer.clear()
+                whisper.discard()
                 recorder.reset()
                 src_lang, tgt_lang = state_machine.get_translate_languages()
                 splitscreen_renderer.setLanguages(src_lang, tgt_lang)
@@ -144,15 +220,23 @@ def main(model_str):
             wav = None
             next_button_pressed = False
             prev_button_pressed = False
+            # Evaluate the start of the LLM prompt while the user speaks.
+            # With whisper in a worker, partial transcripts extend it.
+            llm_speaker.prefill()
+            partial_words, n_submitted = [], 0
             while wav is None and not (next_button_pressed or
                                        prev_button_pressed):
                 wav = recorder.record_voice()
+                if wav is None and not inline_whisper:
+                    partial_words, n_submitted = prefill_partial(
+                        partial_words, n_submitted)
                 handle_menu(draw=False, prompt_word='Prompt:')
                 next_button_pressed = buttons.up_pressed()
                 prev_button_pressed = buttons.down_pressed()
+            whisper.discard()
             s = None
             if wav is not None:
-                s = whisper.run(wav).strip()
+                s = transcribe(wav, prompt_word='Prompt:')
                 printc("yellow", s)
             state_change = state_machine.update_state(s, next_button_pressed,
                                                       prev_button_pressed)
@@ -164,7 +248,9 @@ def main(model_str):
                 if get_current_volume() != 0:
                     time.sleep(2.0)
                 # Wait for tts.
-                total_string = ''
+                transcript.clear()
+                if streamer is not None:
+                    streamer.reset()
                 recorder.reset()
             elif state_change == AIBoxState.TRANSLATE:
                 renderer.clear()
@@ -194,8 +280,10 @@ def main(model_str):
                 next_button_pressed = buttons.up_pressed()
                 prev_button_pressed = buttons.down_pressed()
             s = None
-            if wav is not None:
-                s = whisper.run(wav).strip()
+            if wav is not None and not (next_button_pressed or
+                                        prev_button_pressed):
+                # Voice commands are only recognized in English.
+                s = transcribe(wav, draw=True)
                 printc("yellow", s)
 
             src_lang, tgt_lang = state_machine.get_translate_languages()
@@ -211,7 +299,9 @@ def main(model_str):
                 if get_current_volume() != 0:
                     time.sleep(2.0)
                 # Wait for tts.
-                total_string = ''
+                transcript.clear()
+                if streamer is not None:
+                    streamer.reset()
                 recorder.reset()
             elif state_change == AIBoxState.CHATTY:
                 # Switching from caption box to chatty
@@ -228,8 +318,8 @@ def main(model_str):
                 splitscreen_renderer.setLanguages(src_lang, tgt_lang)
                 recorder.reset()
             elif s is not None:
-                if src_lang != 'en':
-                    s = whisper.run(wav, src_lang=src_lang_code).strip()
+                if src_lang_code != 'en':
+                    s = transcribe(wav, src_lang=src_lang_code, draw=True)
                 splitscreen_renderer.clearTop()
                 splitscreen_renderer.clearBottom()
                 fontfile = lang_to_font(src_lang)
@@ -245,5 +335,30 @@ def main(model_str):
 
 
 if __name__ == "__main__":
-    assert len(sys.argv) == 2, "usage: python3 main.py <model_name>"
-    sys.exit(main(sys.argv[1]))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_name')
+    parser.add_argument('replay',
+                        nargs='?',
+                        help='WAV or .npy recording to use instead of the '
+                        'microphone.')
+    parser.add_argument('--streaming_captions',
+                        action='store_true',
+                        help='Commit caption words by local agreement.')
+    parser.add_argument('--inline_whisper',
+                        action='store_true',
+                        help='Decode in the main process instead of a '
+                        'worker.')
+    parser.add_argument('--whisper_models',
+                        nargs='+',
+                        default=['tiny'],
+                        help='Whisper variants to switch between, smallest '
+                        'first, e.g. tiny base.  Each one loads its own '
+                        'model.')
+    parser.add_argument('--caption_language',
+                        default='english',
+                        help='Spoken language to caption, e.g. chinese.')
+    args = parser.parse_args()
+    sys.exit(
+        main(args.model_name, args.replay, args.streaming_captions,
+             args.inline_whisper, args.whisper_models,
+             args.caption_language))
@@ -1,4 +1,7 @@
+import functools
+
 from Levenshtein import distance
+import numpy as np
 
 
 # Given two sequences of words, determine the ratio of correct matches to incorrect matches.
@@ -12,6 +15,90 @@ def similarity(a, b, use_distance=True):
     return overlap
 
 
+@functools.lru_cache(maxsize=None)
+def _offset_pairs(n_a, n_b, n_offsets):
+    # The items similarity(a[a_idx:], b) compares for each offset, where
+    # a_idx = max(0, n_a - n_b + offset) and a is at most n_b long.  Returns
+    # (offset, index in a, index in b) of every compared pair.
+    starts = np.maximum(0, n_a - n_b + np.arange(n_offsets))
+    lengths = np.minimum(n_a - starts, n_b)
+    offsets = np.repeat(np.arange(n_offsets), lengths)
+    b_idx = np.arange(len(offsets)) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths)
+    return offsets, np.repeat(starts, lengths) + b_idx, b_idx
+
+
+def character_offset_scores(a, b, n_offsets):
+    ''' similarity(a[a_idx:], b, use_distance=False) for each of the first
+    n_offsets offsets, where a_idx = max(0, len(a) - len(b) + offset).
+    '''
+    # Only the last len(b) characters of a are ever compared.
+    a = a[max(0, len(a) - len(b)):]
+    offsets, a_idx, b_idx = _offset_pairs(len(a), len(b), n_offsets)
+    a_codes = np.frombuffer(a.encode('utf-32-le'), dtype=np.uint32)
+    b_codes = np.frombuffer(b.encode('utf-32-le'), dtype=np.uint32)
+    return np.bincount(offsets[a_codes[a_idx] == b_codes[b_idx]],
+                       minlength=n_offsets)
+
+
+class WordMatcher(object):
+    ''' similarity() of word lists for every combine offset in one pass.
+
+    Words get ids and whether two of them are within edit distance 2 is kept
+    in an ids x ids table, so captions, which see the same words over and
+    over, only compute the distance of pairs not seen before.  The table is
+    cleared once `max_words` distinct words have been seen.
+    '''
+
+    def __init__(self, max_words=1024):
+        self.max_words = max_words
+        self.close = np.empty((max_words, max_words), dtype=np.int8)
+        self.clear()
+
+    def clear(self):
+        self.ids = {}
+        self.words = []
+        self.close.fill(-1)  # Not computed yet.
+
+    def _lookup(self, words):
+        ids = [self.ids.get(word) for word in words]
+        if None in ids:
+            if len(self.words) + len(words) > self.max_words:
+                self.clear()
+            for i, word in enumerate(words):
+                idx = self.ids.get(word)
+                if idx is None:
+                    idx = self.ids[word] = len(self.words)
+                    self.words.append(word)
+                    self.close[idx, idx] = 1
+                ids[i] = idx
+        return np.array(ids, dtype=np.intp)
+
+    def offset_scores(self, a, b, n_offsets):
+        ''' similarity(a[a_idx:], b) for each of the first n_offsets offsets,
+        where a_idx = max(0, len(a) - len(b) + offset).
+        '''
+        # Only the last len(b) words of a are ever compared.
+        a = a[max(0, len(a) - len(b)):]
+        offsets, a_idx, b_idx = _offset_pairs(len(a), len(b), n_offsets)
+        ids = self._lookup(list(a) + list(b))
+        a_ids = ids[:len(a)][a_idx]
+        b_ids = ids[len(a):][b_idx]
+        close = self.close[a_ids, b_ids]
+        unknown = close < 0
+        if unknown.any():
+            a_new, b_new = a_ids[unknown], b_ids[unknown]
+            words = self.words
+            close[unknown] = self.close[a_new, b_new] = [
+                distance(words[a_id], words[b_id]) <= 2
+                for a_id, b_id in zip(a_new.tolist(), b_new.tolist())
+            ]
+        return np.bincount(offsets[close == 1], minlength=n_offsets)
+
+
+_word_matcher = WordMatcher()
+
+
 def combine_characters(a, b):
     ''' Line up the two input strings of utf8 characters so that they match as
     closely as possible then splice them together.
@@ -27,12 +114,10 @@ def combine_characters(a, b):
     MAX_NEW_WORDS = 10
     max_similarity = 0
     max_similarity_offset = 0
-    for offset in range(min(len(b), MAX_NEW_WORDS)):
-        a_idx = max(0, len(a) - len(b) + offset)
-        sim = similarity(a[a_idx:], b, use_distance=False)
-        if sim > max_similarity:
-            max_similarity = sim
-            max_similarity_offset = offset
+    scores = character_offset_scores(a, b, min(len(b), MAX_NEW_WORDS))
+    if len(scores) > 0:
+        max_similarity_offset = int(np.argmax(scores))
+        max_similarity = scores[max_similarity_offset]
 
     if max_similarity == 0:
         return a + b, False, len(b)
@@ -76,12 +161,11 @@ def combine_words(a, b):
           ][-COMBINATION_WINDOW_LEN:]
     max_similarity = 0
     max_similarity_offset = 0
-    for offset in range(min(len(b_s), MAX_NEW_WORDS)):
-        a_idx = max(0, len(a_s) - len(b_s) + offset)
-        sim = similarity(a_s[a_idx:], b_s)
-        if sim > max_similarity:
-            max_similarity = sim
-            max_similarity_offset = offset
+    scores = _word_matcher.offset_scores(a_s, b_s,
+                                         min(len(b_s), MAX_NEW_WORDS))
+    if len(scores) > 0:
+        max_similarity_offset = int(np.argmax(scores))
+        max_similarity = scores[max_similarity_offset]
 
     if max_similarity == 0:
         return a + ' ' + b, False, len(b_s)
@@ -103,3 +187,147 @@ def combine_words(a, b):
     ])
 
     return ' '.join(out_wordlist), needs_update, max_similarity_offset
+
+
+class Transcript(object):
+    ''' Caption text kept as words, for splicing in new transcriptions without
+    re-splitting the whole session.
+
+    Words before the spliced tail never change, so combine() and revise() cost
+    O(tail) however long the session runs.  `offsets` caches where each word
+    starts in the text, the words joined by single spaces, and `last_edit`
+    holds the characters to erase and the text to write to turn the previous
+    text into the current one.
+
+    With `characters` set the units are characters joined without spaces, for
+    languages written without them, and combine() follows combine_characters.
+    '''
+
+    def __init__(self, characters=False):
+        self.characters = characters
+        self.separator = '' if characters else ' '
+        self.clear()
+
+    def clear(self):
+        self.words = []
+        self.offsets = []
+        self.n_chars = 0
+        self.last_edit = (0, '')
+
+    def __len__(self):
+        return len(self.words)
+
+    @property
+    def text(self):
+        return self.separator.join(self.words)
+
+    def _splice(self, keep, new_words):
+        # Replaces the words from index `keep` on, tracking the character edit.
+        old = self.separator.join(self.words[keep:])
+        new = self.separator.join(new_words)
+        # Words after the first are preceded by the separator.
+        if keep > 0:
+            old = self.separator + old if len(old) > 0 else old
+            new = self.separator + new if len(new) > 0 else new
+        n_same = 0
+        for old_char, new_char in zip(old, new):
+            if old_char != new_char:
+                break
+            n_same += 1
+        self.last_edit = (len(old) - n_same, new[n_same:])
+
+        del self.words[keep:]
+        del self.offsets[keep:]
+        self.n_chars = self.offsets[-1] + len(self.words[-1]) \
+            if keep > 0 else 0
+        for word in new_words:
+            offset = self.n_chars + len(
+                self.separator) if len(self.words) > 0 else 0
+            self.words.append(word)
+            self.offsets.append(offset)
+            self.n_chars = offset + len(word)
+
+    def combine(self, b):
+        ''' Splices transcription b into the end of the text, exactly as
+        combine_words(self.text, b), or combine_characters in character mode,
+        would.
+
+        Returns (needs_update, number of new words)
+        '''
+        if self.characters:
+            b_words = list(b)
+        else:
+            b_words = [word for word in b.split(' ') if word != '']
+        self.last_edit = (0, '')
+        if len(self.words) == 0:
+            self._splice(0, b_words)
+            return False, len(b_words)
+        if b == "":
+            return False, 0
+
+        COMBINATION_WINDOW_LEN = 15
+        MAX_NEW_WORDS = 10
+        n_a = len(self.words)
+        max_similarity = 0
+        max_similarity_offset = 0
+        if self.characters:
+            b_s = b_words
+            scores = character_offset_scores(
+                ''.join(self.words[-len(b_s):]), b,
+                min(len(b_s), MAX_NEW_WORDS))
+        else:
+            b_s = b_words[-COMBINATION_WINDOW_LEN:]
+            scores = _word_matcher.offset_scores(
+                self.words[-len(b_s):], b_s, min(len(b_s), MAX_NEW_WORDS))
+        if len(scores) > 0:
+            max_similarity_offset = int(np.argmax(scores))
+            max_similarity = scores[max_similarity_offset]
+
+        if max_similarity == 0:
+            self._splice(n_a, b_words)
+            return False, len(b_s)
+        # Prevent editing of old text when nothing new is present.
+        if max_similarity_offset == 0 and len(b_s) < n_a:
+            return False, 0
+
+        # Shorten to max overlap length for combination step.
+        if not self.characters:
+            b_s = b_s[-MAX_NEW_WORDS:]
+        keep = max(0, n_a - (len(b_s) - max_similarity_offset))
+        n_out = keep + len(b_s)
+
+        def out_word(idx):
+            idx = idx + n_out if idx < 0 else idx
+            return self.words[idx] if idx < keep else b_s[idx - keep]
+
+        words_to_check = min(MAX_NEW_WORDS, n_a,
+                             n_out - max_similarity_offset)
+        if self.characters:
+            start_out = n_out - words_to_check - max_similarity_offset
+            needs_update = any([
+                out_word(start_out + i) != self.words[n_a - words_to_check +
+                                                      i]
+                for i in range(words_to_check)
+            ])
+        else:
+            needs_update = any([
+                out_word(-i - max_similarity_offset) != self.words[-i]
+                for i in range(words_to_check)
+            ])
+        self._splice(keep, b_s)
+        return needs_update, max_similarity_offset
+
+    def revise(self, words, start):
+        ''' Replaces the words from index `start` on, e.g. the tentative
+        words of a streaming transcription.
+
+        Returns (needs_update, number of new words) like combine().
+        '''
+        n_old = len(self.words)
+        n_common = 0
+        for old_word, new_word in zip(self.words[start:], words):
+            if old_word != new_word:
+                break
+            n_common += 1
+        self._splice(start, words)
+        return start + n_common < n_old, max(0, len(self.words) - n_old)
@@ -10,53 +10,94 @@ We're looking for:
 """
 
 import numpy as np
-import copy
-
 
 class PredictionFilters():
 
     def _filter_hallucination_impl(self, words):
         ''' If a pattern with up to PHRASE_LEN is found more than REPEAT_THRESHOLD times,
-            all further repeats are sliced from the output string.
+            all further repeats are sliced from the output.
+
+            The result is the same as repeatedly slicing the first such repeat
+            (lowest start, then shortest phrase) and searching again from the
+            start, in one pass.  A slice only changes the words after it, so
+            the search resumes just far enough back to cover every start whose
+            first REPEAT_THRESHOLD + 1 phrases reach past it.
         '''
         REPEAT_THRESHOLD = 3
         PHRASE_LEN = 8
-        for idx in range(len(words) - REPEAT_THRESHOLD):
+        n_copies = REPEAT_THRESHOLD + 1
+        lookahead = n_copies * (PHRASE_LEN - 1)
+        # Filtered words, followed by the unread words[n_read:].
+        out = []
+        n_read = 0
+        idx = 0
+        while True:
+            if len(out) < idx + lookahead:
+                n_new = idx + lookahead - len(out)
+                out.extend(words[n_read:n_read + n_new])
+                n_read = min(len(words), n_read + n_new)
+            n_words = len(out) + len(words) - n_read
+            if idx + n_copies > n_words:
+                break
             for phrase_len in range(1, PHRASE_LEN):
-                if idx + phrase_len * REPEAT_THRESHOLD <= len(words):
-                    first_phrase = words[idx:idx + phrase_len]
-                    repeats_found = 1
-                    words_left = len(words) - idx
-                    for repeat_num in range(1, int(words_left / phrase_len)):
-                        start_idx = idx + repeat_num * phrase_len
-                        test_phrase = words[start_idx:start_idx + phrase_len]
-                        if first_phrase == test_phrase:
-                            repeats_found += 1
-                        else:
-                            break
-
-                    if repeats_found > REPEAT_THRESHOLD:
-                        left = words[:idx + REPEAT_THRESHOLD * phrase_len]
-                        right = words[idx + repeats_found * phrase_len:]
-                        return left + right, True
-        return words, False
+                if idx + n_copies * phrase_len > n_words:
+                    idx += 1
+                    break
+                phrase = out[idx:idx + phrase_len]
+                repeats = 1
+                while repeats < n_copies and out[
+                        idx + repeats * phrase_len:idx +
+                        (repeats + 1) * phrase_len] == phrase:
+                    repeats += 1
+                if repeats < n_copies:
+                    continue
+                # Count the whole run, reading further as needed.  Blocks of
+                # copies double while they match, so long loops take few
+                # comparisons.
+                block = 1
+                while True:
+                    block = min(block,
+                                (n_words - idx) // phrase_len - repeats)
+                    if block == 0:
+                        break
+                    start_idx = idx + repeats * phrase_len
+                    end_idx = start_idx + block * phrase_len
+                    if len(out) < end_idx:
+                        n_new = max(end_idx - len(out), lookahead)
+                        out.extend(words[n_read:n_read + n_new])
+                        n_read = min(len(words), n_read + n_new)
+                    if out[start_idx:end_idx] == phrase * block:
+                        repeats += block
+                        block *= 2
+                    elif block > 1:
+                        block = 1
+                    else:
+                        break
+                cut_idx = idx + REPEAT_THRESHOLD * phrase_len
+                del out[cut_idx:idx + repeats * phrase_len]
+                idx = max(0, cut_idx - lookahead + 1)
+                break
+            else:
+                idx += 1
+        out.extend(words[n_read:])
+        return out
 
     def filter_hallucinations(self, text, characters=False):
-        ''' Filter repeatedly until all hallucinations have been removed from the
-            text. Filtering repeatedly seems helpful in cases where the user
+        ''' Filter all hallucinations from the text.  Filtering until every
+            repeat is gone seems helpful in cases where the user
             intentionally says a word more than the threshold number of times,
             then a legitimate hallucination is found.
         '''
         # Certain hallucinatinos appear as a sequence of '!!!!' with no spaces.
-        if len(text) > 15 and len(text.split()) <= 1:
+        # Languages written without spaces leave such loops to the repeat
+        # filter below.
+        if not characters and len(text) > 15 and len(text.split()) <= 1:
             return ''
         # "you" is the default output of whisper with no audio. '.' or '...' show up in silent clips.
         if text is None or text == 'you' or text == '.' or text == '...':
             print("filtering - no new meaningful text found")
             return ''
-        words = copy.copy(text) if characters else text.split()
-        keep_filtering = True
-        while keep_filtering:
-            words, keep_filtering = self._filter_hallucination_impl(words)
+        words = list(text) if characters else text.split()
+        words = self._filter_hallucination_impl(words)
 
-        return words if characters else ' '.join(words)
+        return ''.join(words) if characters else ' '.join(words)
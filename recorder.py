@@ -1,51 +1,52 @@
-import os
-import queue
 import subprocess
 import time
 
 import numpy as np
-import sounddevice as sd
-import torch
 
+from capture import CaptureEngine, SileroVad, SlidingWindowPolicy
 from input_chunk_filter import ChunkHPFilter
+from transcriber import InputBuffer
 
 
 class Recorder(object):
 
-    def __init__(self, tts_signal=True):
+    def __init__(self,
+                 tts_signal=True,
+                 energy_gate=True,
+                 background=False,
+                 input_buffer=None,
+                 source=None):
         self.max_duration = 10  # seconds
         self.rate = 16000
         self.buff_size = int(30 * self.rate)  # Record a 30-second buffer.
         self.chunk_sz = self.rate // 10  # 100ms @ 16KHz
         self.channels = 1
-        self.buff_idx = 0
-        self.vad_chunk_idx = 0
         self.recording_voice = False
-
-        # audio buffer in int16
-        self.buff = np.zeros((self.buff_size), dtype=np.float32)
-        self.vad_chunks = np.zeros((int(self.buff_size / self.chunk_sz)),
-                                   dtype=np.float32)
-
-        self.q = queue.Queue()
-        self.hp_filter = ChunkHPFilter(fc=50)
-        torch.set_num_threads(1)
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        self.vad, _ = torch.hub.load(
-            repo_or_dir=(f"{dir_path}/downloaded/snakers4_silero-vad_master"),
-            source='local',
-            model='silero_vad',
-            force_reload=False,
-            onnx=True)
-        sd.default.channels = self.channels, self.channels
-        sd.default.dtype = 'int32', 'int32'
-        sd.default.samplerate = self.rate, self.rate
-
-        self.in_stream = sd.InputStream(samplerate=self.rate,
-                                        blocksize=self.chunk_sz,
-                                        channels=self.channels,
-                                        callback=self._audio_callback)
+        self.endpoint_latency = None
+        # Audio is returned in whisper's padded input, usually the
+        # transcriber's own buffer so it is not copied again.
+        self.input_buffer = InputBuffer() if input_buffer is None \
+            else input_buffer
+
+        n_chunks = int(self.buff_size / self.chunk_sz)
+        self.policy = SlidingWindowPolicy(n_chunks, self.chunk_sz)
+        # 20-bits of audio are copied into lowest 16-bits, meaning we should
+        # keep 4 extra bits.
+        hp_filter = ChunkHPFilter(fc=50, scale=2**-27)
+        # The queue holds at most as much audio as the ring buffer, older
+        # chunks would be overwritten before they could be read anyway.
+        self.engine = CaptureEngine(self.policy,
+                                    SileroVad(self.rate, energy_gate),
+                                    hp_filter,
+                                    rate=self.rate,
+                                    chunk_sz=self.chunk_sz,
+                                    dtype=np.int32,
+                                    channels=self.channels,
+                                    queue_chunks=n_chunks)
+        self.in_stream = self.engine.open_stream(source)
         self.in_stream.start()
+        if background:
+            self.engine.start_worker()
 
         # Signal to tts that audio output can start.  This is required for
         # AI in a Box because audio input must be configured before audio output
@@ -57,99 +58,149 @@ class Recorder(object):
                 f'audio input stream started successfully: {self.in_stream.active}'
             )
 
-    def _audio_callback(self, indata, frames, time_info, status):
-        self.q.put(np.frombuffer(indata, dtype=np.int32).flatten())
+    @property
+    def buff(self):
+        # Audio ordered oldest first, a view into the ring buffer.
+        return self.policy.audio_ring.flat_view()
 
-    def preprocess_audio(self, audio):
-        # 20-bits of audio are copied into lowest 16-bits, meaning we should
-        # keep 4 extra bits.
-        x = audio.astype(dtype=np.float32)
-        x = self.hp_filter.run(x) / (2**27)
-        x = x.astype(np.float32)
-        return x, self.vad(torch.from_numpy(x), 16000).item()
-
-    def process_audio_chunk(self):
-        audio, vad = self.preprocess_audio(self.q.get())
-        if self.buff_idx < self.buff_size:
-            self.buff[self.buff_idx:self.buff_idx + self.chunk_sz] = audio
-            self.vad_chunks[self.vad_chunk_idx] = vad
-            self.buff_idx += self.chunk_sz
-            self.vad_chunk_idx += 1
-        else:
-            self.buff[:-self.chunk_sz] = self.buff[self.chunk_sz:]
-            self.buff[-self.chunk_sz:] = audio
-            self.vad_chunks[:-1] = self.vad_chunks[1:]
-            self.vad_chunks[-1] = vad
+    @property
+    def vad_chunks(self):
+        return self.policy.vad_ring.view()
+
+    @property
+    def buff_idx(self):
+        return len(self.policy.audio_ring) * self.chunk_sz
+
+    @property
+    def vad_chunk_idx(self):
+        return len(self.policy.vad_ring)
+
+    def vad_skip_ratio(self):
+        """Fraction of chunks that did not need the neural VAD."""
+        return self.engine.vad.skip_ratio()
+
+    def get_vad_state(self):
+        """Returns a copy of the VAD scores, oldest first, and their count."""
+        with self.engine.lock:
+            self.engine.sync()
+            return self.vad_chunks.copy(), self.vad_chunk_idx
+
+    def capture_stats(self):
+        return self.engine.stats()
 
     def record_voice(self):
-        if not self.recording_voice:
-            self.recording_voice = True
-            self.reset()
-
-        for _ in range(self.q.qsize()):
-            self.process_audio_chunk()
-
-        preamble_chunks = 3  # 300ms of extra audio.
-        vad_inds = np.nonzero(self.vad_chunks > 0.9)[0]
-        if len(vad_inds) == 0:
-            return None
-        first_vad_sample = max(0, vad_inds[0] - preamble_chunks)
-
-        last_idx = self.vad_chunk_idx
-        for i in range(len(vad_inds) - 1, 0, -1):
-            if last_idx - vad_inds[i] > 10:
-                src_start_idx = first_vad_sample * self.chunk_sz
-                src_end_idx = (vad_inds[i] + 10) * self.chunk_sz
-                samples_to_copy = src_end_idx - src_start_idx
-                audio_buff = np.zeros((self.buff_size), dtype=np.float32)
-                audio_buff[:samples_to_copy] = self.buff[
-                    src_start_idx:src_end_idx]
-                self.buff_idx = 0
-                self.vad_chunk_idx = 0
-                self.buff.fill(0.0)
-                self.vad_chunks.fill(0.0)
-                self.recording_voice = False
-                return audio_buff
-            last_idx = vad_inds[i]
+        with self.engine.lock:
+            if not self.recording_voice:
+                self.recording_voice = True
+                self.reset()
+
+            self.engine.sync()
+
+            utterance = self.policy.utterance()
+            if utterance is None:
+                return None
+            audio_buff = self.input_buffer.write(utterance)
+            endpointer = self.policy.endpointer
+            self.endpoint_latency = time.monotonic(
+            ) - endpointer.last_voice_time
+            print(f'end of speech to whisper: {self.endpoint_latency:.3f}s '
+                  f'({endpointer.hangover / 10:.1f}s hangover)')
+            self.policy.reset()
+            self.recording_voice = False
+            return audio_buff
+
+    def partial_voice(self, min_samples=0, max_silent_chunks=3):
+        """The utterance record_voice() is waiting for, so far.
+
+        Returns a copy of its audio, or None if no speech is in progress, if
+        the last `max_silent_chunks` chunks were unvoiced so it is probably
+        ending, or if it is shorter than `min_samples`.
+        """
+        with self.engine.lock:
+            if not self.recording_voice:
+                return None
+            self.engine.sync()
+            endpointer = self.policy.endpointer
+            if not endpointer.in_speech or endpointer.n_chunks - 1 - \
+                    endpointer.last_voice >= max_silent_chunks:
+                return None
+            # Checked before copying, this runs on every loop of the caller.
+            n_chunks = min(endpointer.n_chunks - endpointer.start,
+                           len(self.policy.vad_ring))
+            if n_chunks * self.chunk_sz < min_samples:
+                return None
+            utterance = self.policy.utterance(partial=True)
+            return utterance.copy()
 
     def get_audio(self):
-        for _ in range(self.q.qsize()):
-            self.process_audio_chunk()
-
-        end_idx = self.vad_chunk_idx
-        audio_start_idx = max(
-            0, end_idx - self.max_duration * 10)  # Return ten seconds buffer.
-        vad_start_idx = max(0, end_idx - 3 * 10)  # 3 seconds of voice activity.
-        last_ten_seconds = self.buff[audio_start_idx * self.chunk_sz:end_idx *
-                                     self.chunk_sz]
-        # Return samples padded to native whisper length.
-        x = np.pad(last_ten_seconds, (0, (30 - self.max_duration) * self.rate),
-                   'constant')
-        chunks_with_vad = np.sum(self.vad_chunks[vad_start_idx:end_idx] > 0.5)
-        return x, chunks_with_vad
+        with self.engine.lock:
+            self.engine.sync()
+
+            end_idx = self.vad_chunk_idx
+            audio_start_idx = max(
+                0,
+                end_idx - self.max_duration * 10)  # Return ten seconds buffer.
+            vad_start_idx = max(0,
+                                end_idx - 3 * 10)  # 3 seconds of voice activity.
+            last_ten_seconds = self.buff[audio_start_idx *
+                                         self.chunk_sz:end_idx * self.chunk_sz]
+            # Stream position of the window, so the mel front end can reuse
+            # frames from the previous, overlapping window.
+            ring = self.policy.audio_ring
+            start_chunk = ring.total_written - len(ring) + audio_start_idx
+            # Return samples padded to native whisper length.
+            x = self.input_buffer.write(last_ten_seconds,
+                                        start_sample=start_chunk *
+                                        self.chunk_sz)
+            chunks_with_vad = np.sum(
+                self.vad_chunks[vad_start_idx:end_idx] > 0.5)
+            return x, chunks_with_vad
+
+    def get_audio_since(self, start_sample=None, max_duration=None):
+        """Writes the audio from stream position `start_sample` to now into
+        the whisper input.
+
+        The start is clamped to the buffered audio and to the last
+        `max_duration` seconds.  Returns (audio, start sample of the audio,
+        VAD scores of its chunks).
+        """
+        with self.engine.lock:
+            self.engine.sync()
+            ring = self.policy.audio_ring
+            end_chunk = ring.total_written
+            start_chunk = end_chunk - len(ring)
+            if start_sample is not None:
+                start_chunk = max(start_chunk, start_sample // self.chunk_sz)
+            if max_duration is not None:
+                start_chunk = max(
+                    start_chunk,
+                    end_chunk - int(max_duration * self.rate / self.chunk_sz))
+            start_chunk = min(start_chunk, end_chunk)
+            start_idx = start_chunk - (end_chunk - len(ring))
+            end_idx = len(ring)
+            x = self.input_buffer.write(
+                self.buff[start_idx * self.chunk_sz:end_idx * self.chunk_sz],
+                start_sample=start_chunk * self.chunk_sz)
+            return x, start_chunk * self.chunk_sz, self.vad_chunks[
+                start_idx:end_idx].copy()
 
     def reset(self):
-        for _ in range(self.q.qsize()):
-            self.process_audio_chunk()
-        self.buff_idx = 0
-        self.buff.fill(0.0)
-        self.vad_chunk_idx = 0
-        self.vad_chunks.fill(0.0)
-        self.hp_filter.reset()
-        self.vad.reset_states()
+        self.engine.reset()
 
 
 from transcriber import Transcriber
 import time
 if __name__ == '__main__':
     """Example call:  `taskset -c 4-7 python3 recorder.py`."""
-    recorder = Recorder(tts_signal=False)
-    recorder.reset()
-
     t = Transcriber()
+    recorder = Recorder(tts_signal=False,
+                        background=True,
+                        input_buffer=t.input_buffer)
+    recorder.reset()
     while True:
         clip, vad = recorder.get_audio()
-        print(f'vad {vad}')
+        print(f'vad {vad}, skipped {recorder.vad_skip_ratio():.0%} of chunks, '
+              f'{recorder.capture_stats()}')
 
         if (vad > 0):
             print("Transcription:\n", t.run(clip), "\n")
@@ -1,6 +1,8 @@
+import unicodedata
+
 import pygame
 
-from fontfile import lang_to_font
+from fontfile import lang_is_unspaced, lang_to_font
 from volume_file import get_current_volume, set_current_volume
 import pygame_menu
 
@@ -65,14 +67,29 @@ class BaseDisplay:
         return self.surface.get_width()
 
 
+# Punctuation that may not start a line of unspaced text, it takes the
+# character before it along to the next line instead.
+NO_LINE_START = set('、。，．・：；？！ー）」』】〕〉》ゃゅょっャュョッ,.:;?!)')
+
+
 class TextWindow:
 
-    def __init__(self, display, rect, text_size, text_color, fontfile):
+    def __init__(self,
+                 display,
+                 rect,
+                 text_size,
+                 text_color,
+                 fontfile,
+                 spaced=True):
         self.display = display
         self.rect = rect
         self.text_size = text_size
         self.text_color = text_color
         self.fontfile = fontfile
+        # Unspaced text, e.g. Chinese, is added a character at a time and
+        # may break between any two characters.
+        self.spaced = spaced
+        self.font = pygame.font.Font(self.fontfile, self.text_size)
         sample_text = self.render_text("Testing")
         self.text_height = sample_text.get_height()
         self.left, self.top, self.width, self.height = rect
@@ -83,8 +100,7 @@ class TextWindow:
         self.x_offset = 0
 
     def render_text(self, text):
-        font = pygame.font.Font(self.fontfile, self.text_size)
-        return font.render(text, True, self.text_color)
+        return self.font.render(text, True, self.text_color)
 
     def scroll(self):
         print(f' scrolling cur line {self.current_line} n lines {self.n_lines}')
@@ -107,8 +123,17 @@ class TextWindow:
 
         cur = self.lines[0]
         word_to_add = word + ' ' if add_spaces else word
+        if not add_spaces and len(word) > 0 and len(cur) > 0 and \
+                unicodedata.category(word[0]) in ('Mn', 'Mc'):
+            # Combining marks, e.g. Thai vowels and tones, are drawn with
+            # the character they belong to.
+            word_to_add = self._pop_last() + word_to_add
         text = self.render_text(word_to_add)
         if self.x_offset + text.get_width() > self.width:
+            if not add_spaces and len(self.lines[0]) > 0 and \
+                    word_to_add[:1] in NO_LINE_START:
+                word_to_add = self._pop_last() + word_to_add
+                text = self.render_text(word_to_add)
             self.scroll()
 
         self.lines[0].append(word_to_add)
@@ -126,6 +151,16 @@ class TextWindow:
             self.display.flip()  #update(rect)
         self.x_offset += text.get_width()
 
+    def _pop_last(self):
+        # Erases the last word of the current line and returns it.
+        last = self.lines[0].pop()
+        width = self.render_text(last).get_width()
+        self.x_offset -= width
+        y_offset = min(self.n_lines - 1, self.current_line) * self.text_height
+        pygame.draw.rect(self.surface, (0, 0, 0),
+                         (self.x_offset, y_offset, width, self.text_height))
+        return last
+
     def addWords(self, words, add_spaces=True, update=True):
         for word in words:
             self.addWord(word, add_spaces=add_spaces, update=update)
@@ -138,8 +173,11 @@ class TextWindow:
                          (0, y_offset, self.width, clear_height))
         self.x_offset = 0
         lines_to_update = self.lines[:lines_cleared]
-        line_lengths = [len(line) for line in lines_to_update
-                       ]  #[len(line) for line in self.lines[:lines_cleared]]
+        # Unspaced lines may hold characters drawn together, count them all.
+        line_lengths = [
+            len(line) if self.spaced else len(''.join(line))
+            for line in lines_to_update
+        ]  #[len(line) for line in self.lines[:lines_cleared]]
         words_to_update = sum(line_lengths)
 
         self.lines = self.lines[lines_cleared:]
@@ -148,7 +186,7 @@ class TextWindow:
             self.lines.append([])
         new_words = new_words if words_to_update >= len(
             new_words) else new_words[-words_to_update:]
-        self.addWords(new_words, update=False)
+        self.addWords(new_words, add_spaces=self.spaced, update=False)
         rect = [self.left, self.top + y_offset, self.width, clear_height]
         self.display.update(rect)
 
@@ -163,13 +201,14 @@ class TextWindow:
 
 class SingleScreenRenderer:
 
-    def __init__(self, display):
+    def __init__(self, display, lang='english'):
         self.display = display
         self.window = TextWindow(display,
                                  rect=(50, 50, 1180, 620),
                                  text_color=(255, 255, 255),
-                                 fontfile=lang_to_font('english'),
-                                 text_size=70)
+                                 fontfile=lang_to_font(lang),
+                                 text_size=70,
+                                 spaced=not lang_is_unspaced(lang))
 
     def clear(self):
         self.display.clear()
@@ -182,7 +221,7 @@ class SingleScreenRenderer:
         self.window.scroll()
 
     def addWords(self, words):
-        self.window.addWords(words)
+        self.window.addWords(words, add_spaces=self.window.spaced)
 
     def updateNLines(self, n_lines, new_words):
         self.window.updateNLines(n_lines, new_words)
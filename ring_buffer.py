@@ -0,0 +1,75 @@
+"""Fixed size ring buffer of audio frames with zero-copy ordered views."""
+import numpy as np
+
+
+class RingBuffer:
+    """Stores the most recent `n_frames` frames, oldest first.
+
+    Every frame is written twice, at its slot and one capacity further along,
+    so any run of up to `n_frames` consecutive frames is contiguous in memory
+    and can be returned as a view without copying or shifting.  Until the
+    buffer has wrapped the ordered view starts at slot 0 with the unwritten
+    frames left at zero, matching a plain array that is filled left to right.
+    """
+
+    def __init__(self, n_frames, frame_shape=(), dtype=np.float32):
+        self.n_frames = n_frames
+        self.frame_shape = tuple(frame_shape)
+        self.data = np.zeros((2 * n_frames,) + self.frame_shape, dtype=dtype)
+        self.write_idx = 0  # Slot the next frame is written to.
+        self.n_written = 0  # Frames written since reset, saturates at n_frames.
+        self.total_written = 0  # Frames written since construction.
+
+    def __len__(self):
+        return self.n_written
+
+    def full(self):
+        return self.n_written == self.n_frames
+
+    def append(self, frame):
+        self.data[self.write_idx] = frame
+        self.data[self.write_idx + self.n_frames] = frame
+        self.write_idx = (self.write_idx + 1) % self.n_frames
+        self.n_written = min(self.n_written + 1, self.n_frames)
+        self.total_written += 1
+
+    def extend(self, frames):
+        """Appends a batch of frames, oldest first."""
+        frames = frames[-self.n_frames:]
+        n = len(frames)
+        if n == 0:
+            return
+        end = self.write_idx + n
+        if end <= self.n_frames:
+            self.data[self.write_idx:end] = frames
+            self.data[self.write_idx + self.n_frames:end + self.n_frames] = \
+                frames
+        else:
+            # The batch wraps, write it in two pieces around the end slot.
+            split = self.n_frames - self.write_idx
+            self.data[self.write_idx:self.n_frames] = frames[:split]
+            self.data[self.write_idx + self.n_frames:] = frames[:split]
+            self.data[:n - split] = frames[split:]
+            self.data[self.n_frames:self.n_frames + n - split] = frames[split:]
+        self.write_idx = end % self.n_frames
+        self.n_written = min(self.n_written + n, self.n_frames)
+        self.total_written += n
+
+    def view(self, start=0, end=None):
+        """Returns a view of ordered frames [start, end), oldest at 0.
+
+        Indices address the full capacity, as with a plain array, so frames
+        past len(self) read as zero before the buffer has wrapped.
+        """
+        end = self.n_frames if end is None else end
+        offset = self.write_idx if self.full() else 0
+        return self.data[offset + start:offset + end]
+
+    def flat_view(self, start=0, end=None):
+        """Like view() but with the frame axis merged into the sample axis."""
+        return self.view(start, end).reshape((-1,) + self.frame_shape[1:])
+
+    def reset(self):
+        self.data.fill(0)
+        self.write_idx = 0
+        self.n_written = 0
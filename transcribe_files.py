@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Offline transcription of recordings, for regression runs and reprocessing
+field captures.
+
+Each file is high-pass filtered and split into utterances with the same
+Silero VAD and endpointer the live recorder uses, then the utterances are
+transcribed in parallel by a pool of processes, each with its own
+Transcriber.  Writes <out_dir>/<name>.txt with one timed line per utterance
+and <out_dir>/stats.json with per-file timings.
+
+Example call:  `python3 transcribe_files.py field_captures/ --jobs 4`.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import numpy as np
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.ogg', '.npy')
+RATE = 16000
+CHUNK_SZ = RATE // 10  # 100ms @ 16KHz
+MAX_SEGMENT_CHUNKS = 30 * RATE // CHUNK_SZ  # Whisper sees at most 30s.
+
+# Per process state of the pool workers.
+_worker = {}
+
+
+def _init_worker(model):
+    from capture import SileroVad
+    from prediction_filters import PredictionFilters
+    from transcriber import Transcriber
+
+    _worker['whisper'] = Transcriber(model=model)
+    _worker['vad'] = SileroVad(RATE)
+    _worker['pred_filter'] = PredictionFilters()
+    _worker['audio'] = (None, None)
+
+
+def _load(path):
+    """High-pass filtered audio of `path` in chunks, cached per worker."""
+    from audio_source import ReplaySource
+    from input_chunk_filter import ChunkHPFilter
+
+    if _worker['audio'][0] == path:
+        return _worker['audio'][1]
+    source = ReplaySource.from_file(path)
+    audio = source.audio
+    if source.rate != RATE:
+        from scipy.signal import resample_poly
+        audio = resample_poly(audio, RATE, source.rate).astype(np.float32)
+    n_chunks = -(-len(audio) // CHUNK_SZ)
+    chunks = np.zeros((n_chunks, CHUNK_SZ), dtype=np.float32)
+    chunks.reshape(-1)[:len(audio)] = audio
+    # Same filter as the recorder, on audio already scaled to [-1, 1].
+    chunks = ChunkHPFilter(fc=50).run_batch(chunks)
+    _worker['audio'] = (path, chunks)
+    return chunks
+
+
+def segment(scores, max_chunks=MAX_SEGMENT_CHUNKS):
+    """Splits per-chunk VAD scores into (start, end, voiced chunks)."""
+    from capture import Endpointer
+
+    endpointer = Endpointer()
+    segments = []
+    offset = 0
+    for i in range(len(scores)):
+        endpointer.update(scores[i:i + 1])
+        end = endpointer.end
+        if end is None and endpointer.in_speech and \
+                endpointer.n_chunks - endpointer.start >= max_chunks:
+            end = endpointer.n_chunks
+        if end is not None:
+            segments.append(
+                (offset + endpointer.start, offset + end, endpointer.n_voiced))
+            offset = i + 1
+            endpointer.reset()
+    if endpointer.in_speech:
+        segments.append((offset + endpointer.start,
+                         offset + endpointer.n_chunks, endpointer.n_voiced))
+    return segments
+
+
+def _segment_file(path):
+    t0 = time.perf_counter()
+    chunks = _load(path)
+    vad = _worker['vad']
+    vad.reset()
+    scores = vad.score(chunks)
+    return path, len(chunks), segment(scores), time.perf_counter() - t0
+
+
+def _transcribe_segments(task):
+    path, segments, language = task
+    chunks = _load(path)
+    results = []
+    for idx, start, end, _ in segments:
+        t0 = time.perf_counter()
+        text = _worker['whisper'].run(chunks[start:end].reshape(-1),
+                                      src_lang=language).strip()
+        text = _worker['pred_filter'].filter_hallucinations(text)
+        results.append((idx, text, time.perf_counter() - t0))
+    return path, results
+
+
+def batch_segments(segments, batch_chunks):
+    """Deals the segments of one file, longest first, into batches of about
+    `batch_chunks` chunks.  Returns lists of (index, start, end, voiced)."""
+    order = sorted(range(len(segments)),
+                   key=lambda idx: segments[idx][0] - segments[idx][1])
+    n_chunks = sum(end - start for start, end, _ in segments)
+    n_batches = max(1, min(len(segments), -(-n_chunks // batch_chunks)))
+    return [[(idx, ) + tuple(segments[idx])
+             for idx in order[batch::n_batches]]
+            for batch in range(n_batches)]
+
+
+def find_audio_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if name.lower().endswith(AUDIO_EXTENSIONS))
+        else:
+            files.append(path)
+    return files
+
+
+def transcribe_files(files, out_dir, model='tiny', jobs=None, language='en'):
+    jobs = os.cpu_count() if jobs is None else jobs
+    os.makedirs(out_dir, exist_ok=True)
+    t_start = time.perf_counter()
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(jobs, initializer=_init_worker,
+                  initargs=(model,)) as pool:
+        stats = {}
+        segments_of = {}
+        for path, n_chunks, segments, vad_seconds in pool.imap_unordered(
+                _segment_file, files):
+            stats[path] = {
+                'file': path,
+                'audio_seconds': n_chunks * CHUNK_SZ / RATE,
+                'segments': len(segments),
+                'speech_seconds': sum(e - s for s, e, _ in segments) / 10,
+                'vad_seconds': vad_seconds,
+                'decode_seconds': 0.,
+                'transcript': [None] * len(segments),
+                'bounds': segments,
+            }
+            if len(segments) > 0:
+                # A file without speech would only be reloaded for nothing.
+                segments_of[path] = segments
+
+        # Workers keep only the last file they loaded, so each task is a
+        # batch of segments from one file, loaded once.  About four batches
+        # per process, biggest first, keep the pool busy to the end.
+        n_chunks = sum(end - start for segments in segments_of.values()
+                       for start, end, _ in segments)
+        batch_chunks = max(MAX_SEGMENT_CHUNKS, n_chunks // (4 * jobs))
+        tasks = [(path, batch, language)
+                 for path, segments in segments_of.items()
+                 for batch in batch_segments(segments, batch_chunks)]
+        tasks.sort(key=lambda task: -sum(end - start
+                                         for _, start, end, _ in task[1]))
+        for path, results in pool.imap_unordered(_transcribe_segments,
+                                                 tasks):
+            for idx, text, decode_seconds in results:
+                stats[path]['transcript'][idx] = text
+                stats[path]['decode_seconds'] += decode_seconds
+    wall_seconds = time.perf_counter() - t_start
+
+    for path in files:
+        file_stats = stats[path]
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(os.path.join(out_dir, f'{name}.txt'), 'w') as f:
+            for (start, end, _), text in zip(file_stats.pop('bounds'),
+                                             file_stats.pop('transcript')):
+                f.write(f'[{start / 10:8.1f} - {end / 10:8.1f}] {text}\n')
+        file_stats['real_time_factor'] = (
+            file_stats['vad_seconds'] + file_stats['decode_seconds']) / max(
+                file_stats['audio_seconds'], 1e-3)
+    with open(os.path.join(out_dir, 'stats.json'), 'w') as f:
+        json.dump([stats[path] for path in files], f, indent=2)
+
+    audio_seconds = sum(s['audio_seconds'] for s in stats.values())
+    print(f'{len(files)} files, {audio_seconds:.1f}s of audio in '
+          f'{wall_seconds:.1f}s with {jobs} processes '
+          f'({audio_seconds / wall_seconds:.1f}x real time)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths',
+                        nargs='+',
+                        help='Audio files or directories of them.')
+    parser.add_argument('--out_dir', default='transcripts')
+    parser.add_argument('--model', default='tiny')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=None,
+                        help='Worker processes, one per core by default.')
+    parser.add_argument('--language', default='en')
+    args = parser.parse_args()
+    transcribe_files(find_audio_files(args.paths), args.out_dir, args.model,
+                     args.jobs, args.language)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
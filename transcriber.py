@@ -1,15 +1,587 @@
+import collections
+import multiprocessing as mp
+import time
+from multiprocessing import shared_memory
+
 from useful_transformers.whisper import WhisperModel
 import numpy as np
 
+from printing import printc
+
+WHISPER_RATE = 16000
+WHISPER_SAMPLES = 30 * WHISPER_RATE  # Whisper always sees 30 seconds.
+N_FFT = 400
+HOP_LENGTH = 160
+N_FRAMES = WHISPER_SAMPLES // HOP_LENGTH
+
+
+class InputBuffer():
+    """Reusable zero padded 30 second whisper input.
+
+    Writing overwrites only the live region and re-zeroes whatever the last
+    write left past it, so no large array is allocated per transcription.  The
+    returned audio is a view that the next write overwrites.  `start_sample`
+    optionally records the stream position of the first sample, which lets
+    the mel front end reuse frames computed for earlier, overlapping writes.
+    """
+
+    def __init__(self):
+        self.batch = np.zeros((1, WHISPER_SAMPLES), dtype=np.float32)
+        self.audio = self.batch[0]
+        self.n_valid = 0
+        self.start_sample = None
+
+    def write(self, audio, start_sample=None):
+        n = min(len(audio), WHISPER_SAMPLES)
+        self.audio[:n] = audio[:n]
+        if n < self.n_valid:
+            self.audio[n:self.n_valid] = 0.
+        self.n_valid = n
+        self.start_sample = start_sample
+        return self.audio
+
+
+def mel_filters(rate=WHISPER_RATE, n_fft=N_FFT, n_mels=80):
+    """Slaney style mel filterbank, as librosa.filters.mel builds it."""
+
+    def hz_to_mel(f):
+        f = np.asarray(f, dtype=np.float64)
+        mels = 3. * f / 200.
+        log_region = f >= 1000.
+        return np.where(log_region,
+                        15. + np.log(np.maximum(f, 1e-10) / 1000.) /
+                        (np.log(6.4) / 27.), mels)
+
+    def mel_to_hz(m):
+        freqs = 200. * m / 3.
+        log_region = m >= 15.
+        return np.where(log_region,
+                        1000. * np.exp(np.log(6.4) / 27. * (m - 15.)), freqs)
+
+    fft_freqs = np.linspace(0, rate / 2, 1 + n_fft // 2)
+    mel_freqs = mel_to_hz(
+        np.linspace(hz_to_mel(0.), hz_to_mel(rate / 2), n_mels + 2))
+    fdiff = np.diff(mel_freqs)
+    ramps = mel_freqs[:, np.newaxis] - fft_freqs[np.newaxis, :]
+    lower = -ramps[:-2] / fdiff[:-1, np.newaxis]
+    upper = ramps[2:] / fdiff[1:, np.newaxis]
+    weights = np.maximum(0, np.minimum(lower, upper))
+    weights *= (2. / (mel_freqs[2:] - mel_freqs[:-2]))[:, np.newaxis]
+    return weights.astype(np.float32)
+
+
+class StreamingMelFrontEnd():
+    """Whisper's log-mel spectrogram with frames cached by stream position.
+
+    Consecutive caption windows overlap by all but a few hundred ms, so the
+    log-mel frames that lie entirely inside audio seen before are taken from
+    a cache keyed by their absolute frame index.  Frames touching the window
+    edges are recomputed, and frames entirely in the zero padding share one
+    precomputed value.  Only the final normalization runs over all 3000
+    frames.
+    """
+
+    def __init__(self, n_mels=80):
+        self.filters = mel_filters(n_mels=n_mels)
+        n = np.arange(N_FFT)
+        self.window = (0.5 - 0.5 * np.cos(2 * np.pi * n / N_FFT)).astype(
+            np.float32)
+        # Power is zero in the padding, clamped to 1e-10 before the log.
+        self.pad_value = np.float32(np.log10(1e-10))
+        self.padded = np.zeros((WHISPER_SAMPLES + N_FFT,), dtype=np.float32)
+        self.padded_valid = 0
+        self.log_spec = np.empty((n_mels, N_FRAMES), dtype=np.float32)
+        # Enough slots that a window never evicts its own frames.
+        self.cache = np.zeros((n_mels, 2 * N_FRAMES), dtype=np.float32)
+        self.cache_frame = np.full((2 * N_FRAMES,), -1, dtype=np.int64)
+
+    def _log_mel_frames(self, frame_idx):
+        frames = np.lib.stride_tricks.sliding_window_view(
+            self.padded, N_FFT)[::HOP_LENGTH][frame_idx]
+        power = np.abs(np.fft.rfft(frames * self.window, axis=-1))**2
+        mel = self.filters @ power.T.astype(np.float32)
+        return np.log10(np.maximum(mel, 1e-10))
+
+    def run(self, audio, n_valid, start_sample=None):
+        """Returns the (1, n_mels, 3000) log-mel input for 30s of `audio`.
+
+        `audio` is zero past `n_valid`.  Frames are only cached when
+        `start_sample`, the stream position of audio[0], is given and falls
+        on a frame boundary.
+        """
+        half = N_FFT // 2
+        # Center each frame with reflection at both ends, like torch.stft.
+        self.padded[half:half + n_valid] = audio[:n_valid]
+        if n_valid < self.padded_valid:
+            self.padded[half + n_valid:half + self.padded_valid] = 0.
+        self.padded_valid = n_valid
+        self.padded[:half] = audio[half:0:-1]
+        self.padded[-half:] = audio[-2:-half - 2:-1]
+
+        t = np.arange(N_FRAMES)
+        # Frames made only of padding zeros share one value.
+        in_padding = (t * HOP_LENGTH - half >= n_valid) & \
+            (t * HOP_LENGTH + half <= WHISPER_SAMPLES)
+        self.log_spec[:, in_padding] = self.pad_value
+
+        cacheable = np.zeros((N_FRAMES,), dtype=bool)
+        if start_sample is not None and start_sample % HOP_LENGTH == 0:
+            cacheable = (t * HOP_LENGTH - half >= 0) & \
+                (t * HOP_LENGTH + half <= n_valid)
+            abs_frame = start_sample // HOP_LENGTH + t
+            slot = abs_frame % self.cache.shape[1]
+            hit = cacheable & (self.cache_frame[slot] == abs_frame)
+            self.log_spec[:, hit] = self.cache[:, slot[hit]]
+            compute = ~in_padding & ~hit
+        else:
+            compute = ~in_padding
+
+        frame_idx = np.nonzero(compute)[0]
+        if len(frame_idx) > 0:
+            self.log_spec[:, frame_idx] = self._log_mel_frames(frame_idx)
+            store = frame_idx[cacheable[frame_idx]]
+            if len(store) > 0:
+                self.cache[:, slot[store]] = self.log_spec[:, store]
+                self.cache_frame[slot[store]] = abs_frame[store]
+
+        log_spec = np.maximum(self.log_spec, self.log_spec.max() - 8.0)
+        return ((log_spec + 4.0) / 4.0)[np.newaxis]
+
+
+def _worker_main(model, shm_name, n_slots, conn):
+    whisper = Transcriber(model=model)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = np.ndarray((n_slots, WHISPER_SAMPLES),
+                       dtype=np.float32,
+                       buffer=shm.buf)
+    requests = collections.deque()
+    first_wanted_id = 0
+    running = True
+    while running:
+        # Reads everything sent so far before decoding, so requests discarded
+        # while they waited are skipped.
+        while running and (len(requests) == 0 or conn.poll()):
+            message = conn.recv()
+            if message is None:
+                running = False
+            elif isinstance(message, int):
+                first_wanted_id = message
+            else:
+                requests.append(message)
+        if not running:
+            break
+        request_id, slot, n_valid, start_sample, task, src_lang = \
+            requests.popleft()
+        if request_id < first_wanted_id:
+            conn.send((request_id, None))
+            continue
+        # Copying out frees the slot for the next request straight away.
+        buff = whisper.input_buffer.write(slots[slot, :n_valid], start_sample)
+        conn.send((request_id, whisper.run(buff, task=task,
+                                           src_lang=src_lang)))
+    del slots
+    shm.close()
+
+
+class TranscriberWorker(object):
+    """Runs a Transcriber in a separate process.
+
+    Audio is copied into one of `n_slots` shared memory slots, so only a small
+    request tuple is pickled.  Requests are answered in order and at most
+    `n_slots` can be pending.  Each carries an id.  Discarded requests the
+    worker has not started are skipped, and the result of one already
+    running is dropped when it arrives.
+    """
+
+    def __init__(self, model, n_slots=2):
+        self.n_slots = n_slots
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=n_slots * WHISPER_SAMPLES *
+                                              np.dtype(np.float32).itemsize)
+        self.slots = np.ndarray((n_slots, WHISPER_SAMPLES),
+                                dtype=np.float32,
+                                buffer=self.shm.buf)
+        self.next_slot = 0
+        self.n_pending = 0
+        self.next_id = 0
+        self.first_wanted_id = 0
+        # Spawned rather than forked, the parent runs audio threads.
+        ctx = mp.get_context('spawn')
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main,
+                                   args=(model, self.shm.name, n_slots,
+                                         child_conn),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, buff, n_valid, start_sample, task, src_lang):
+        assert self.n_pending < self.n_slots, 'all worker slots are in use'
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.n_slots
+        self.slots[slot, :n_valid] = buff[:n_valid]
+        self.conn.send(
+            (self.next_id, slot, n_valid, start_sample, task, src_lang))
+        self.next_id += 1
+        self.n_pending += 1
+
+    def poll(self, timeout=0):
+        """Returns the oldest pending text, or None if not ready in time."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.n_pending > 0:
+            remaining = None if deadline is None else max(
+                0, deadline - time.monotonic())
+            if not self.conn.poll(remaining):
+                return None
+            self.n_pending -= 1
+            request_id, text = self.conn.recv()
+            if request_id >= self.first_wanted_id:
+                return text
+        return None
+
+    def discard(self):
+        """Drops the results of everything submitted so far, without waiting.
+
+        Their slots stay in use until the worker has answered them.
+        """
+        self.first_wanted_id = self.next_id
+        self.conn.send(self.first_wanted_id)
+
+    def close(self):
+        self.conn.send(None)
+        self.process.join()
+        del self.slots
+        self.shm.close()
+        self.shm.unlink()
+
 
 class Transcriber():
+    """Whisper transcription, inline or in a worker process.
 
-    def __init__(self, model='tiny.en'):
-        self.model = WhisperModel(model=model)
+    submit() starts transcribing and poll() returns the text, so a caller can
+    keep capturing and rendering while a worker decodes.  Inline, submit()
+    decodes straight away.  run() does both and waits.
+    """
 
-    def run(self, buff, task='transcribe', src_lang='en'):
-        mel = self.model.mel_spectrogram(buff[np.newaxis])
-        tokens = self.model.decode_no_timestamps(mel,
+    def __init__(self, model='tiny.en', worker=False, input_buffer=None):
+        self.worker = TranscriberWorker(model) if worker else None
+        self.model = None if worker else WhisperModel(model=model)
+        self.results = collections.deque()
+        self.input_buffer = InputBuffer() if input_buffer is None \
+            else input_buffer
+        self.mel_front_end = StreamingMelFrontEnd()
+
+    def mel_spectrogram(self, buff):
+        """Log-mel of `buff`, reusing cached frames for the shared buffer."""
+        if buff is not self.input_buffer.audio:
+            buff = self.input_buffer.write(buff)
+        if self.input_buffer.start_sample is None:
+            return self.model.mel_spectrogram(self.input_buffer.batch)
+        return self.mel_front_end.run(buff, self.input_buffer.n_valid,
+                                      self.input_buffer.start_sample)
+
+    def decode(self, features, task='transcribe', src_lang='en'):
+        tokens = self.model.decode_no_timestamps(features,
                                                  task=task,
                                                  src_lang=src_lang)
         return self.model.tokenizer.decode(tokens)
+
+    def submit(self, buff, task='transcribe', src_lang='en'):
+        """Starts transcribing `buff`, poll() returns the text."""
+        if self.worker is None:
+            self.results.append(self.run(buff, task=task, src_lang=src_lang))
+            return
+        # Waits for a slot, keeping any results that arrive for poll().
+        while self.worker.n_pending == self.worker.n_slots:
+            text = self.worker.poll(timeout=None)
+            if text is not None:
+                self.results.append(text)
+        if buff is self.input_buffer.audio:
+            n_valid = self.input_buffer.n_valid
+            start_sample = self.input_buffer.start_sample
+        else:
+            n_valid = min(len(buff), WHISPER_SAMPLES)
+            start_sample = None
+        self.worker.submit(buff, n_valid, start_sample, task, src_lang)
+
+    @property
+    def n_pending(self):
+        n_pending = len(self.results)
+        if self.worker is not None:
+            n_pending += self.worker.n_pending
+        return n_pending
+
+    def poll(self, timeout=0):
+        """Text of the oldest submitted audio, or None if not ready.
+
+        Waits up to `timeout` seconds, or until done if `timeout` is None.
+        """
+        if len(self.results) > 0:
+            return self.results.popleft()
+        if self.worker is None:
+            return None
+        return self.worker.poll(timeout)
+
+    def run(self, buff, task='transcribe', src_lang='en'):
+        if self.worker is not None:
+            self.submit(buff, task=task, src_lang=src_lang)
+            # Answers come in order, so this request's is the last.  Earlier
+            # ones stay queued for poll() and discarded ones are skipped.
+            while True:
+                text = self.worker.poll(timeout=None)
+                if self.worker.n_pending == 0:
+                    return text
+                self.results.append(text)
+        return self.decode(self.mel_spectrogram(buff),
+                           task=task,
+                           src_lang=src_lang)
+
+    def discard(self):
+        """Drops the results of everything submitted so far."""
+        if self.worker is not None:
+            self.worker.discard()
+        self.results.clear()
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.close()
+
+
+class StreamingTranscriber():
+    """Caption transcription that commits words by local agreement.
+
+    Each pass decodes the audio from the start of the current segment to now.
+    A word is committed once two consecutive hypotheses of the same segment
+    agree on it and everything before it.  A segment ends at a pause, once
+    its whole hypothesis is stable, or when it reaches `max_duration`, where
+    it is cut at its quietest chunk.  The next segment starts there, so each
+    decode covers at most `max_duration` seconds however long someone talks.
+    With `characters` set the units are characters, for languages written
+    without spaces.
+    """
+
+    def __init__(self,
+                 transcriber,
+                 max_duration=10,
+                 pause_chunks=5,
+                 vad_threshold=0.5,
+                 text_filter=None,
+                 characters=False):
+        self.transcriber = transcriber
+        self.max_duration = max_duration
+        self.pause_chunks = pause_chunks
+        self.vad_threshold = vad_threshold
+        self.text_filter = text_filter
+        self.characters = characters
+        self.reset()
+
+    def reset(self):
+        self.committed = []
+        self.start_sample = None
+        self._reset_segment()
+
+    def _reset_segment(self, cut_tail=()):
+        self.hypothesis = []
+        self.n_segment_committed = 0
+        # Words committed just before a cut, the segment may hear them again.
+        self.cut_tail = list(cut_tail)
+
+    def _strip_overlap(self, words):
+
+        def norm(word):
+            return word.lower().strip('.,?!。，？！')
+
+        for k in range(min(len(words), len(self.cut_tail)), 0, -1):
+            if [norm(w) for w in words[:k]
+               ] == [norm(w) for w in self.cut_tail[-k:]]:
+                return words[k:]
+        return words
+
+    def step(self, recorder, task='transcribe', src_lang='en'):
+        """Runs one pass on the recorder's latest audio.
+
+        Returns (newly committed words, tentative words).
+        """
+        buff, self.start_sample, vad = recorder.get_audio_since(
+            self.start_sample, self.max_duration)
+        chunk_sz = recorder.chunk_sz
+        voiced = vad > self.vad_threshold
+        if not voiced.any():
+            # Nothing said since the segment started, skip the silence.
+            self.start_sample += len(vad) * chunk_sz
+            self._reset_segment()
+            return [], []
+
+        text = self.transcriber.run(buff, task=task, src_lang=src_lang).strip()
+        if self.text_filter is not None:
+            text = self.text_filter(text)
+        words = list(text) if self.characters else text.split()
+        n_heard = len(words)
+        words = self._strip_overlap(words)
+        # Committed words at the start of the audio, heard again.
+        n_stripped = n_heard - len(words)
+
+        n_agreed = 0
+        for prev, curr in zip(self.hypothesis, words):
+            if prev != curr:
+                break
+            n_agreed += 1
+        new_words = words[self.n_segment_committed:n_agreed]
+        self.n_segment_committed = max(self.n_segment_committed, n_agreed)
+        self.hypothesis = words
+
+        n_trailing_silence = len(voiced) - 1 - np.nonzero(voiced)[0][-1]
+        if n_trailing_silence >= self.pause_chunks and n_agreed == len(words):
+            # Pause after a stable hypothesis, start afresh after it.
+            self.start_sample += (len(vad) - n_trailing_silence) * chunk_sz
+            self._reset_segment()
+        elif len(vad) * chunk_sz >= self.max_duration * recorder.rate:
+            # No pause in sight.  Only agreed words are committed, so cut at
+            # the quietest chunk before the last of them starts, assuming a
+            # steady speaking rate, and the next segment hears the rest
+            # again.  Committed words heard again are stripped from it.
+            n_committed = n_stripped + self.n_segment_committed
+            n_agreed_end = min(
+                len(vad),
+                len(vad) * max(0, n_committed - 1) // max(1, n_heard))
+            if n_agreed_end == 0:
+                # Nothing agreed in a whole window, move on regardless.
+                n_agreed_end = len(vad)
+            lo = n_agreed_end // 2
+            cut = lo + int(np.argmin(vad[lo:n_agreed_end]))
+            self.start_sample += cut * chunk_sz
+            self.committed += new_words
+            self._reset_segment(cut_tail=self.committed[-n_committed:]
+                                if n_committed > 0 else [])
+            return new_words, []
+
+        self.committed += new_words
+        return new_words, self.hypothesis[self.n_segment_committed:]
+
+
+class AdaptiveTranscriber(object):
+    """Switches between whisper variants to hold a decode latency target.
+
+    `models` are ordered smallest first and all share one input buffer.
+    Latency from submit to result is smoothed per variant.  Above
+    `target_latency` the next smaller variant takes over, and below
+    `headroom` times the target the next larger one is tried.  A switch
+    waits `min_decodes` decodes after the previous one, and a larger variant
+    that was already too slow is only retried after `retry_decodes`.
+    """
+
+    def __init__(self,
+                 models=('tiny', 'base'),
+                 target_latency=1.5,
+                 headroom=0.5,
+                 min_decodes=5,
+                 retry_decodes=50,
+                 smoothing=0.3,
+                 worker=False):
+        self.models = list(models)
+        self.target_latency = target_latency
+        self.headroom = headroom
+        self.min_decodes = min_decodes
+        self.retry_decodes = retry_decodes
+        self.smoothing = smoothing
+        self.input_buffer = InputBuffer()
+        self.variants = [
+            Transcriber(model=model,
+                        worker=worker,
+                        input_buffer=self.input_buffer) for model in models
+        ]
+        self.latency = [None] * len(models)
+        self.current = 0
+        self.n_since_switch = 0
+        # (variant, submit time, audio seconds) of each pending decode.
+        self.pending = collections.deque()
+        self.results = collections.deque()
+
+    @property
+    def model(self):
+        return self.models[self.current]
+
+    def _update(self, variant, latency, audio_seconds):
+        prev = self.latency[variant]
+        self.latency[variant] = latency if prev is None else \
+            prev + self.smoothing * (latency - prev)
+        if variant != self.current:
+            return
+        self.n_since_switch += 1
+        if self.n_since_switch < self.min_decodes:
+            return
+        current = self.latency[self.current]
+        if current > self.target_latency and self.current > 0:
+            self._switch(self.current - 1, audio_seconds)
+        elif current < self.headroom * self.target_latency and \
+                self.current + 1 < len(self.variants):
+            larger = self.latency[self.current + 1]
+            if larger is None or larger < self.target_latency or \
+                    self.n_since_switch >= self.retry_decodes:
+                self._switch(self.current + 1, audio_seconds)
+
+    def _switch(self, variant, audio_seconds):
+        latency = self.latency[self.current]
+        printc(
+            "magenta", f"whisper {self.models[self.current]} -> "
+            f"{self.models[variant]}: latency {latency:.2f}s, real-time "
+            f"factor {latency / max(audio_seconds, 1e-3):.2f}, target "
+            f"{self.target_latency:.2f}s")
+        self.current = variant
+        self.n_since_switch = 0
+
+    def _audio_seconds(self, buff):
+        if buff is self.input_buffer.audio:
+            return self.input_buffer.n_valid / WHISPER_RATE
+        return min(len(buff), WHISPER_SAMPLES) / WHISPER_RATE
+
+    def submit(self, buff, task='transcribe', src_lang='en'):
+        self.pending.append(
+            (self.current, time.monotonic(), self._audio_seconds(buff)))
+        self.variants[self.current].submit(buff,
+                                           task=task,
+                                           src_lang=src_lang)
+
+    @property
+    def n_pending(self):
+        # Includes discarded requests still holding a worker slot.
+        return len(self.results) + sum(variant.n_pending
+                                       for variant in self.variants)
+
+    def poll(self, timeout=0):
+        if len(self.results) > 0:
+            return self.results.popleft()
+        if len(self.pending) == 0:
+            # Anything still in a worker was discarded, drop what is done.
+            for variant in self.variants:
+                if variant.n_pending > 0:
+                    variant.poll(timeout)
+            return None
+        variant, t_submit, audio_seconds = self.pending[0]
+        text = self.variants[variant].poll(timeout)
+        if text is not None:
+            self.pending.popleft()
+            self._update(variant, time.monotonic() - t_submit, audio_seconds)
+        return text
+
+    def run(self, buff, task='transcribe', src_lang='en'):
+        # Earlier submissions stay queued for poll().
+        while len(self.pending) > 0:
+            self.results.append(self.poll(timeout=None))
+        variant = self.current
+        t0 = time.monotonic()
+        text = self.variants[variant].run(buff,
+                                          task=task,
+                                          src_lang=src_lang)
+        self._update(variant, time.monotonic() - t0,
+                     self._audio_seconds(buff))
+        return text
+
+    def discard(self):
+        for variant in self.variants:
+            variant.discard()
+        self.pending.clear()
+        self.results.clear()
+
+    def close(self):
+        for variant in self.variants:
+            variant.close()